@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Compares the cost of creating a per-request accounts client.
+
+Usage: python benchmarks/accounts_client.py [number]
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+from openstax_accounts.openstax_accounts import OpenstaxAccounts
+
+
+def main(argv=sys.argv):
+    number = int(argv[1]) if len(argv) > 1 else 100000
+    OpenstaxAccounts.singleton({
+        'server_url': 'https://accounts.example.org/',
+        'application_id': 'app-id',
+        'application_secret': 'app-secret',
+        'application_url': 'http://localhost:8000/',
+        })
+    accounts = OpenstaxAccounts()
+
+    def new_client():
+        client = OpenstaxAccounts()
+        client.access_token = 'user-token'
+
+    def bound_client():
+        accounts.bind('user-token')
+
+    for name, func in (('OpenstaxAccounts()', new_client),
+                       ('accounts.bind()', bound_client)):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print('{:<20} {:8.2f} us per client'.format(
+            name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
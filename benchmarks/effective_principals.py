@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Measures the cost of ``effective_principals`` as the number of groups
+and members grows, and of the permission checks of an ACL heavy request
+(``CHECKS`` calls on a new request).
+
+Usage: python benchmarks/effective_principals.py [number]
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+from pyramid import testing
+
+from openstax_accounts.stub import StubAuthenticationPolicy
+
+
+SIZES = ((10, 1000), (100, 10000), (1000, 100000))
+CHECKS = 10
+
+
+def main(argv=sys.argv):
+    number = int(argv[1]) if len(argv) > 1 else 10000
+    for groups, members in SIZES:
+        settings = {
+            'openstax_accounts.login_path': '/login',
+            'openstax_accounts.callback_path': '/callback',
+            }
+        # Every user is a member of one group.
+        for i in range(groups):
+            settings['openstax_accounts.groups.grp_{}'.format(i)] = '\n'.join(
+                'user{}'.format(j) for j in range(i, members, groups))
+        config = testing.setUp(settings=settings)
+        config.include('openstax_accounts.groups')
+        policy = StubAuthenticationPolicy({})
+        username = 'user{}'.format(members - 1)
+
+        def new_request():
+            request = testing.DummyRequest(path='/')
+            request.session['username'] = username
+            return request
+
+        def one_check():
+            policy.effective_principals(new_request())
+
+        def many_checks():
+            request = new_request()
+            for i in range(CHECKS):
+                policy.effective_principals(request)
+
+        for name, func in (('1 check', one_check),
+                           ('{} checks'.format(CHECKS), many_checks)):
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            print('{:>5} groups, {:>6} members, {:>9}: {:8.2f} us per '
+                  'request'.format(groups, members, name,
+                                   seconds / number * 1e6))
+        testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
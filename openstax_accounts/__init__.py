@@ -36,12 +36,10 @@ def includeme(config):
     settings = local_settings(settings)
 
     declare_oauth_routes(config)
-    # Disable SSL certificate verification added in python 2.7.9
-    # See https://bugs.python.org/issue22417
-    if asbool(settings.get('disable_verify_ssl')):
-        import ssl
-        if hasattr(ssl, "_create_unverified_context"):
-            ssl._create_default_https_context = ssl._create_unverified_context
+    config.include('openstax_accounts.profile_store')
+    # Note, ``disable_verify_ssl`` is applied to the TLS context of the
+    # accounts client's connection pool (see ``transport.Transport``)
+    # rather than the process wide default https context.
 
     if asbool(settings.get('stub')):
         # Use the stub authentication policy
@@ -50,4 +48,5 @@ def includeme(config):
         # use the openstax accounts authentication policy
         config.include('openstax_accounts.openstax_accounts')
         config.include('openstax_accounts.authentication_policy')
+    config.include('openstax_accounts.groups')
     config.scan('openstax_accounts.views')
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""asyncio based accounts client (python 3 only).
+
+``AsyncOpenstaxAccounts`` offers the ``IOpenstaxAccounts`` methods as
+coroutines, so that many accounts requests can be in flight on a single
+thread. Once ``config.include('openstax_accounts')`` has run, it uses the
+same settings, TLS context and caches as the blocking client::
+
+    accounts = AsyncOpenstaxAccounts()
+    await accounts.request_application_token()
+    profiles = await asyncio.gather(*[
+        accounts.get_profile_by_username(username)
+        for username in usernames])
+
+"""
+import asyncio
+import http.client
+import io
+import json
+import urllib.parse as urlparse
+from collections import OrderedDict, deque
+from urllib.parse import urlencode
+
+from pyramid.threadlocal import get_current_registry
+
+from .cache import MISSING, TTLCache
+from .interfaces import IMessageSender
+from .metrics import Metrics
+from .openstax_accounts import (
+    BaseOpenstaxAccounts, OpenstaxAccounts, UserNotFoundException,
+    add_access_token, build_message_data, email_addresses, endpoint_name,
+    merge_profile, more_userid_pages, parse_update_response,
+    parser_remove_null_expires_in, send_message)
+from .profile_store import remember_profile
+from .resilience import CircuitBreaker
+from .transport import (
+    DEFAULT_POOL_SIZE, IDEMPOTENT_METHODS, HTTPError, Response,
+    make_ssl_context)
+from .utils import chunked
+
+
+__all__ = ('AsyncOpenstaxAccounts', 'AsyncTransport')
+
+
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+class AsyncTransport(object):
+    """asyncio counterpart of ``transport.Transport``.
+
+    At most ``max_connections`` requests are in flight at once, further
+    requests wait for a free connection. Up to ``pool_size`` idle
+    connections are kept alive per host.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None,
+                 verify_ssl=True, ssl_context=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        if ssl_context is None:
+            ssl_context = make_ssl_context(verify_ssl)
+        self.ssl_context = ssl_context
+        self.max_connections = max_connections
+        self._pools = {}
+        self._semaphore = None
+
+    async def _get_connection(self, key):
+        pool = self._pools.setdefault(key, [])
+        while pool:
+            reader, writer = pool.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == 'https' else None)
+        return reader, writer, False
+
+    def _put_connection(self, key, reader, writer):
+        pool = self._pools.setdefault(key, [])
+        if len(pool) < self.pool_size:
+            pool.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method, url, body=None, headers=None):
+        """Sends the request and returns a ``transport.Response``.
+        Raises ``HTTPError`` for 4xx and 5xx responses.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            if self.timeout is None:
+                return await self._request(method, url, body, headers)
+            return await asyncio.wait_for(
+                self._request(method, url, body, headers), self.timeout)
+
+    async def _request(self, method, url, body, headers):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        default_port = 443 if scheme == 'https' else 80
+        key = (scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        request_headers = OrderedDict([
+            ('Host', parts.netloc),
+            ('Accept-Encoding', 'identity'),
+            ])
+        if body is not None:
+            request_headers['Content-Type'] = (
+                'application/x-www-form-urlencoded')
+        request_headers.update(headers or {})
+        if body is not None or method in ('POST', 'PUT'):
+            request_headers['Content-Length'] = str(len(body or b''))
+        head = ['{} {} HTTP/1.1'.format(method, path)]
+        head.extend('{}: {}'.format(name, value)
+                    for name, value in request_headers.items())
+        payload = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        payload += body or b''
+
+        while True:
+            reader, writer, reused = await self._get_connection(key)
+            sent = False
+            try:
+                writer.write(payload)
+                await writer.drain()
+                sent = True
+                response, will_close = await _read_response(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    http.client.BadStatusLine):
+                writer.close()
+                if reused and (not sent or method in IDEMPOTENT_METHODS):
+                    # The pooled connection went away, try a new one. A
+                    # request with side effects is not sent twice, the
+                    # server may have received it.
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        if will_close:
+            writer.close()
+        else:
+            self._put_connection(key, reader, writer)
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.data))
+        return response
+
+    def close(self):
+        """Closes all the idle connections."""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for reader, writer in pool:
+                writer.close()
+
+
+async def _read_response(reader, method):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('Connection closed by the server')
+    try:
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            + [''])[:3]
+        status = int(status)
+    except ValueError:
+        raise http.client.BadStatusLine(status_line)
+
+    headers = http.client.HTTPMessage()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip()] = value.strip()
+
+    connection = (headers.get('connection') or '').lower()
+    will_close = connection == 'close' or (
+        version == 'HTTP/1.0' and connection != 'keep-alive')
+    transfer_encoding = (headers.get('transfer-encoding') or '').lower()
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        data = b''
+    elif 'chunked' in transfer_encoding:
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip the trailer.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        data = b''.join(chunks)
+    elif headers.get('content-length') is not None:
+        data = await reader.readexactly(int(headers['content-length']))
+    else:
+        data = await reader.read()
+        will_close = True
+    return Response(status, reason, headers, data), will_close
+
+
+class AsyncOpenstaxAccounts(BaseOpenstaxAccounts):
+    """Coroutine based version of ``openstax_accounts.OpenstaxAccounts``.
+
+    Unless they are given, the server and application settings, the
+    caches and the TLS context are those of ``OpenstaxAccounts``,
+    as configured by ``openstax_accounts.openstax_accounts.includeme``.
+    So are the timeouts, retries and circuit breaker.
+    """
+
+    def __init__(self, server_url=None, application_id=None,
+                 application_secret=None, application_url=None,
+                 transport=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.server_url = server_url or OpenstaxAccounts.server_url
+        self.application_id = application_id or OpenstaxAccounts.application_id
+        self.application_secret = (application_secret
+                                   or OpenstaxAccounts.application_secret)
+        self.application_url = (application_url
+                                or OpenstaxAccounts.application_url)
+        if transport is None:
+            sync_transport = OpenstaxAccounts.transport
+            if sync_transport is None:
+                transport = AsyncTransport(max_connections=max_connections)
+            else:
+                transport = AsyncTransport(
+                    pool_size=sync_transport.pool_size,
+                    timeout=sync_transport.timeout,
+                    ssl_context=sync_transport.ssl_context,
+                    max_connections=max_connections)
+        self.transport = transport
+        self.profile_cache = OpenstaxAccounts.profile_cache or TTLCache()
+        self.profile_miss_ttl = OpenstaxAccounts.profile_miss_ttl
+        self.userid_cache = OpenstaxAccounts.userid_cache or TTLCache()
+        self.lookup_batch_size = OpenstaxAccounts.lookup_batch_size
+        self.message_batch_size = OpenstaxAccounts.message_batch_size
+        self.metrics = OpenstaxAccounts.metrics or Metrics()
+        self.conditional_cache = (OpenstaxAccounts.conditional_cache
+                                  or TTLCache(ttl=3600))
+        self.circuit_breaker = (OpenstaxAccounts.circuit_breaker
+                                or CircuitBreaker())
+        self.timeouts = OpenstaxAccounts.timeouts
+        self.retries = OpenstaxAccounts.retries
+        self.retry_backoff = OpenstaxAccounts.retry_backoff
+
+        self.access_token = None
+        self.token_expires = -1
+        self._application = False
+        self.resource_endpoint = self.server_url
+        self.token_endpoint = urlparse.urljoin(self.server_url, '/oauth/token')
+        self.redirect_uri = urlparse.urljoin(self.application_url, '/callback')
+
+    async def _send(self, method, url, data, headers):
+        """Sends the request through the transport, with the endpoint's
+        timeout, retrying failed GET requests, like
+        ``OpenstaxAccounts._send``.
+        """
+        name = endpoint_name(url)
+        self._allow_request(name)
+        timeout = self._timeout(name)
+        attempts = self._attempts(method)
+        loop = asyncio.get_event_loop()
+        for attempt in range(attempts):
+            start = loop.time()
+            try:
+                response = await asyncio.wait_for(self.transport.request(
+                    method, url, body=data, headers=headers), timeout)
+            except (HTTPError, OSError, http.client.HTTPException,
+                    asyncio.TimeoutError) as exc:
+                if not self._record_failure(name, loop.time() - start, exc):
+                    raise
+                error = exc
+            else:
+                self._record_success(name, loop.time() - start, response)
+                return response
+            delay = self._retry_after(attempt, attempts)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        raise error
+
+    async def _request_token(self, **kwargs):
+        kwargs.update({
+            'client_id': self.application_id,
+            'client_secret': self.application_secret,
+            })
+        kwargs.setdefault('grant_type', 'authorization_code')
+        response = await self._send(
+            'POST', self.token_endpoint, urlencode(kwargs), None)
+        data = parser_remove_null_expires_in(response.text)
+        for key in data:
+            setattr(self, key, data[key])
+        if 'expires_in' in data:
+            self.token_expires = (asyncio.get_event_loop().time()
+                                  + data['expires_in'])
+
+    async def request_token_with_code(self, code):
+        await self._request_token(code=code, redirect_uri=self.redirect_uri)
+        self._application = False
+
+    async def request_application_token(self):
+        await self._request_token(grant_type='client_credentials')
+        self._application = True
+
+    @property
+    def _searcher(self):
+        """Who the requests are made as, see ``search_cache_key``."""
+        if self._application:
+            return 'application'
+        return self.access_token
+
+    async def request(self, url, method=None, data=None, headers=None,
+                      parser=None, conditional=False):
+        assert self.access_token is not None
+        parser = parser or json.loads
+        if not method:
+            method = 'GET' if not data else 'POST'
+        url = '{}{}'.format(self.resource_endpoint, url)
+        if not (conditional and method == 'GET'):
+            response = await self._send(
+                method, add_access_token(url, self.access_token), data,
+                headers)
+            return parser(response.text)
+
+        key = (url, self.access_token)
+        cached, headers = self._conditional_headers(key, headers)
+        response = await self._send(
+            method, add_access_token(url, self.access_token), data, headers)
+        return self._conditional_result(key, cached, response, parser)
+
+    async def search(self, query, **kwargs):
+        kwargs['q'] = query
+        return await self.request('/api/application_users.json?{}'.format(
+            urlencode(kwargs)))
+
+    async def global_search(self, query, **kwargs):
+        return await self.request('/api/users.json?{}'.format(
+            urlencode(dict(kwargs, q=query))))
+
+    async def iter_search(self, query, page_size=100, prefetch=1, **kwargs):
+        """Asynchronous generator version of
+        ``OpenstaxAccounts.iter_search``.
+        """
+        def fetch(page):
+            return self.search(query, page=page, per_page=page_size, **kwargs)
+
+        results = await fetch(1)
+        total = results.get('total_count')
+        if total is not None and 0 < len(results['items']) < min(
+                page_size, total):
+            # The server caps the page size.
+            page_size = len(results['items'])
+        pages = None if total is None else -(-total // page_size)
+        next_page = 2
+        pending = deque()
+        try:
+            while True:
+                while pages is not None and next_page <= pages \
+                      and len(pending) < prefetch:
+                    pending.append(asyncio.ensure_future(fetch(next_page)))
+                    next_page += 1
+                items = results['items']
+                for item in items:
+                    yield item
+                if pending:
+                    results = await pending.popleft()
+                elif len(items) == page_size and (pages is None
+                                                  or next_page <= pages):
+                    results = await fetch(next_page)
+                    next_page += 1
+                else:
+                    return
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _resolve_batch(self, usernames):
+        """Maps ``usernames`` to user ids, paging through the results of
+        a ``global_search`` until all of them are found, like
+        ``openstax_accounts.resolve_userids``.
+        """
+        wanted = set(usernames)
+        query = 'username:{}'.format(','.join(usernames))
+        userids = {}
+        page = 1
+        seen = 0
+        while True:
+            if page == 1:
+                users = await self.global_search(query)
+            else:
+                users = await self.global_search(query, page=page)
+            for user in users['items']:
+                if user['username'] in wanted:
+                    wanted.discard(user['username'])
+                    userids[user['username']] = user['id']
+                    self.userid_cache.set(user['username'], user['id'])
+            seen += len(users['items'])
+            if not more_userid_pages(users, seen, wanted):
+                return userids
+            page += 1
+
+    async def _lookup_userid(self, username):
+        userid = (await self._resolve_batch([username])).get(username)
+        if userid is None:
+            raise UserNotFoundException('User "{}" not found'.format(username))
+        return userid
+
+    async def _deliver(self, msg_data):
+        send_msg_util = get_current_registry().queryUtility(
+            IMessageSender, default=send_message)
+        if send_msg_util is send_message:
+            await self.request('/api/messages.json',
+                               data=urlencode(msg_data, True))
+        else:
+            # Other senders (e.g. log or async) may still block, e.g. on
+            # a full queue, so they are called off the event loop.
+            await asyncio.get_event_loop().run_in_executor(
+                None, send_msg_util, msg_data)
+
+    async def send_message(self, username, subject, text_body,
+                           html_body=None):
+        userid = self.userid_cache.get(username)
+        cached = userid is not MISSING
+        if not cached:
+            userid = await self._lookup_userid(username)
+        try:
+            await self._deliver(build_message_data(
+                userid, subject, text_body, html_body))
+        except HTTPError as exc:
+            if not cached or exc.code >= 500:
+                raise
+            # The server rejected the cached user id, which may be stale.
+            self.userid_cache.invalidate(username)
+            userid = await self._lookup_userid(username)
+            await self._deliver(build_message_data(
+                userid, subject, text_body, html_body))
+
+    async def send_messages(self, usernames, subject, text_body,
+                            html_body=None):
+        usernames = list(OrderedDict.fromkeys(usernames))
+        userids = {}
+        unresolved = []
+        for username in usernames:
+            userid = self.userid_cache.get(username)
+            if userid is MISSING:
+                unresolved.append(username)
+            else:
+                userids[username] = userid
+        for found in await asyncio.gather(*[
+                self._resolve_batch(batch)
+                for batch in chunked(unresolved, self.lookup_batch_size)]):
+            userids.update(found)
+
+        results = {}
+        for username in usernames:
+            if username not in userids:
+                results[username] = UserNotFoundException(
+                    'User "{}" not found'.format(username))
+        batches = chunked([username for username in usernames
+                           if username in userids], self.message_batch_size)
+        outcomes = await asyncio.gather(*[
+            self._deliver(build_message_data(
+                [userids[username] for username in batch],
+                subject, text_body, html_body))
+            for batch in batches], return_exceptions=True)
+        for batch, outcome in zip(batches, outcomes):
+            for username in batch:
+                results[username] = True if outcome is None else outcome
+        return results
+
+    async def get_profile(self):
+        return await self.request('/api/user.json', conditional=True)
+
+    async def get_profile_by_username(self, username):
+        profile = self._cached_profile(username)
+        if profile is not MISSING:
+            return profile
+        try:
+            profile = (await self.request(self._profile_path(username),
+                                          conditional=True))['user']
+        except Exception as exc:
+            return self._profile_not_found(username, exc)
+        return self._profile_found(username, profile)
+
+    async def get_profiles_by_usernames(self, usernames, max_workers=10):
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(username):
+            async with semaphore:
+                return await self.get_profile_by_username(username)
+
+        usernames = list(OrderedDict.fromkeys(usernames))
+        profiles = await asyncio.gather(*[
+            fetch(username) for username in usernames])
+        return dict(zip(usernames, profiles))
+
+    async def update_email(self, existing_emails, email):
+        existing = [info['value'] if isinstance(info, dict) else info
+                    for info in existing_emails]
+        if not email or email in existing:
+            return None
+        contact_info = await self.request(
+            '/api/contact_infos.json', data=json.dumps({
+                'type': 'EmailAddress',
+                'value': email,
+                }))
+        if not isinstance(contact_info, dict) or 'value' not in contact_info:
+            contact_info = {'type': 'EmailAddress', 'value': email}
+        return contact_info
+
+    async def update_profile(self, request, **post_data):
+        profile = request.user or {}
+        # separate api for updating email address, sent concurrently
+        updated, contact_info = await asyncio.gather(
+            self.request('/api/user.json', method='PUT',
+                         data=json.dumps(post_data),
+                         parser=parse_update_response),
+            self.update_email(email_addresses(profile),
+                              post_data.get('email')),
+            return_exceptions=True)
+        if isinstance(updated, BaseException):
+            raise updated
+        email_error = None
+        if isinstance(contact_info, BaseException):
+            email_error, contact_info = contact_info, None
+
+        # update request.user, without fetching the profile again
+        if updated is None:
+            me = merge_profile(profile, post_data)
+        else:
+            me = updated
+        if contact_info is not None and contact_info['value'] not in (
+                email_addresses(me)):
+            me = merge_profile(me, {}, contact_info)
+        self._forget_profiles([profile.get('username'), me.get('username')])
+        remember_profile(request, me)
+        if email_error is not None:
+            # The profile was updated, but not the email address.
+            raise email_error
+
+    def close(self):
+        self.transport.close()
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import logging
+import socket
 
 try:
     import urlparse # python2
@@ -8,32 +10,52 @@ try:
     from urllib import urlencode # python2
 except ImportError:
     from urllib.parse import urlencode # moved in python3
+try:
+    import httplib # python2
+except ImportError:
+    import http.client as httplib # renamed in python3
 
 from pyramid.httpexceptions import HTTPFound
-from pyramid.interfaces import IAuthenticationPolicy
 from pyramid.security import Everyone, Authenticated
-from pyramid.settings import aslist
 from zope.interface import implementer
 
+from .groups import get_group_index
 from .interfaces import *
-from .utils import local_settings
+from .profile_store import load_profile, remember_profile
+from .resilience import CircuitOpenError
+from .transport import HTTPError
+from .utils import clear_request_memo, local_settings, memoized_on_request
+
+logger = logging.getLogger('openstax-accounts')
 
 
 def get_user_from_session(request):
     """Create a helper function for getting the user profile from request.user
     """
-    return request.session.get('profile')
+    profile = load_profile(request)
+    if profile is None and request.session.get('profile_key') \
+            and request.session.get('access_token'):
+        # The profile store has lost the profile (e.g. it is local to
+        # another process), fetch it again.
+        try:
+            profile = request.accounts_client.get_profile()
+        except (HTTPError, CircuitOpenError, socket.error,
+                httplib.HTTPException) as exc:
+            # E.g. the access token has expired, the user is not logged
+            # in as far as this request is concerned.
+            logger.warning('Could not fetch the profile of "{}": {!r}'
+                           .format(request.session.get('username'), exc))
+            return None
+        remember_profile(request, profile)
+    return profile
 
 
 def get_accounts_client(request):
     """Create a helper function for returning an accounts client
     with the user's access token
     """
-    client = request.registry.getUtility(IOpenstaxAccounts, 'factory')()
-    access_token = request.session.get('access_token')
-    if access_token:
-        client.access_token = access_token
-    return client
+    accounts = request.registry.getUtility(IOpenstaxAccounts)
+    return accounts.bind(request.session.get('access_token'))
 
 
 @implementer(IOpenstaxAccountsAuthenticationPolicy)
@@ -49,25 +71,17 @@ class OpenstaxAccountsAuthenticationPolicy(object):
         raise HTTPFound(location=request.accounts_client.auth_uri())
 
     def _groups(self, request):
-        """A mapping of group ids a list of user ids"""
-        # TODO Ideally, we'd use the accounts groups, but the implementation
-        #      of groups in accounts is not fleshed out enough at this time.
-        #      So for now we pull them from configuration settings.
-        if not hasattr(self, '_parsed_groups'):
-            self._parsed_groups = {}
-            settings = request.registry.settings
-            prefix = 'openstax_accounts.groups'
-            groups = local_settings(settings, prefix=prefix)
-            for group_name, values in groups.items():
-                self._parsed_groups[group_name] = aslist(values)
-        return self._parsed_groups
+        """A mapping of group ids to (frozen) sets of user ids"""
+        # The groups come from the configuration settings, a groups file
+        # or accounts (``openstax_accounts.groups_from_accounts``),
+        # see ``groups.includeme``.
+        return get_group_index(request).groups
 
     def _membership(self, request, userid):
         """List of groups this `userid` has membership with."""
-        return [group_name
-                for group_name, userids in self._groups(request).items()
-                if userid in userids]
+        return get_group_index(request).membership(userid)
 
+    @memoized_on_request
     def authenticated_userid(self, request):
         if request.path == self.login_path:
             return self._login(request)
@@ -75,18 +89,16 @@ class OpenstaxAccountsAuthenticationPolicy(object):
             code = request.params['code']
             request.accounts_client.request_token_with_code(code)
             me = request.accounts_client.get_profile()
-            request.session.update({
-                'profile': me,
-                'username': me.get('username'),
-                'access_token': request.accounts_client.access_token,
-                })
-            request.session.changed()
+            request.session['access_token'] = \
+                request.accounts_client.access_token
+            remember_profile(request, me)
             return me.get('username')
         return self.unauthenticated_userid(request)
 
     def unauthenticated_userid(self, request):
         return request.session.get('username')
 
+    @memoized_on_request
     def effective_principals(self, request):
         groups = [Everyone]
         userid = self.authenticated_userid(request)
@@ -94,14 +106,15 @@ class OpenstaxAccountsAuthenticationPolicy(object):
             groups.append(Authenticated)
             groups.append(userid)
         # 'g:<name>' indicate group names.
-        groups.extend(['g:{}'.format(name)
-                       for name in self._membership(request, userid)])
+        groups.extend(get_group_index(request).principals(userid))
         return groups
 
     def remember(self, request, principal, **kw):
+        clear_request_memo(request)
         return []
 
     def forget(self, request):
+        clear_request_memo(request)
         if self.unauthenticated_userid(request):
             logout_url = urlparse.urljoin(request.accounts_client.server_url,
                                           '/logout')
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""In-process caches for data fetched from the accounts server."""
+import threading
+import time
+from collections import OrderedDict
+
+
+__all__ = ('MISSING', 'TTLCache')
+
+
+# Returned by ``TTLCache.get`` when there is no (fresh) entry, because
+# ``None`` is a legitimate value to cache.
+MISSING = object()
+
+
+class TTLCache(object):
+    """A thread-safe, bounded LRU mapping whose entries expire.
+
+    ``maxsize`` is the maximum number of entries, the least recently used
+    entry is evicted to make room. ``ttl`` is the default number of seconds
+    an entry is fresh for, it can be overridden per entry in ``set``.
+
+    The cache can also be bounded by memory: when ``maxbytes`` is given,
+    entries are evicted until the total ``sizeof(value)`` of the entries
+    is at most ``maxbytes``. Values larger than ``maxbytes`` are not cached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _pop(self, key):
+        # Must be called with the lock held.
+        expires, value, size = self._data.pop(key)
+        self.bytes -= size
+        return expires, value, size
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                # Expired entries are kept (see ``get_stale``) until they
+                # are evicted or replaced.
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as most recently used.
+            self._pop(key)
+            self._data[key] = entry
+            self.bytes += entry[2]
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key, default=MISSING):
+        """Returns the entry for ``key`` even if it has expired, for use
+        when fresh data can not be had.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        size = 0
+        if self.maxbytes is not None:
+            size = self.sizeof(value)
+            if size > self.maxbytes:
+                self.invalidate(key)
+                return
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            while self._data and (
+                    len(self._data) >= self.maxsize
+                    or (self.maxbytes is not None
+                        and self.bytes + size > self.maxbytes)):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+            self._data[key] = (time.time() + ttl, value, size)
+            self.bytes += size
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def invalidate_if(self, predicate):
+        """Removes the entries whose key matches ``predicate(key)``."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Counters for monitoring the effectiveness of the cache."""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Group membership used by the authentication policies.
+
+Membership is parsed once into a ``GroupIndex``, which maps each user id
+to the (frozen) set of its group principals, e.g. ``g:grp_sol``. The
+index is offered by the ``IGroupProvider`` utility, so the cost of
+``effective_principals`` does not depend on the number of groups or
+members.
+
+When the membership changes (see ``FileGroupProvider`` and
+``AccountsGroupProvider``), a new index is built off the request path
+and swapped in by replacing the provider's ``index`` attribute, so
+requests never see a partially built index and never wait on a lock.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from pyramid.events import ApplicationCreated
+from pyramid.settings import asbool, aslist
+from zope.interface import implementer
+
+from .interfaces import IGroupProvider, IOpenstaxAccounts
+from .utils import local_settings
+
+
+__all__ = (
+    'AccountsGroupProvider', 'FileGroupProvider', 'GroupIndex',
+    'SettingsGroupProvider', 'get_group_index', 'parse_accounts_groups',
+    'parse_groups',
+    )
+
+
+logger = logging.getLogger('openstax-accounts')
+
+
+class GroupIndex(object):
+    """An immutable, inverted index of ``groups``, a mapping of group names
+    to user ids.
+    """
+    empty = frozenset()
+
+    def __init__(self, groups):
+        self.groups = dict((name, frozenset(userids))
+                           for name, userids in groups.items())
+        principals = {}
+        for name, userids in self.groups.items():
+            principal = 'g:{}'.format(name)
+            for userid in userids:
+                principals.setdefault(userid, set()).add(principal)
+        self._principals = dict((userid, frozenset(names))
+                                for userid, names in principals.items())
+
+    def principals(self, userid):
+        """The group principals (``g:<name>``) of ``userid``."""
+        return self._principals.get(userid, self.empty)
+
+    def membership(self, userid):
+        """The names of the groups ``userid`` is a member of."""
+        return [principal[2:] for principal in self.principals(userid)]
+
+
+def parse_groups(settings):
+    """Group membership from the ``openstax_accounts.groups.*``
+    settings, by group name.
+    """
+    groups = local_settings(settings, prefix='openstax_accounts.groups')
+    return dict((name, aslist(values)) for name, values in groups.items())
+
+
+@implementer(IGroupProvider)
+class SettingsGroupProvider(object):
+    """Group membership from the ``openstax_accounts.groups.*`` settings."""
+
+    def __init__(self, settings):
+        self.index = GroupIndex(parse_groups(settings))
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def _parse_groups_file(path):
+    with open(path) as f:
+        groups = json.load(f)
+    if not isinstance(groups, dict) or not all(
+            isinstance(userids, list) for userids in groups.values()):
+        raise ValueError('Expected a mapping of group names to lists of '
+                         'user ids')
+    return groups
+
+
+class _PollingGroupProvider(object):
+    """Base of the providers that ``reload`` the membership in a
+    background thread, every ``interval`` seconds once started.
+    """
+
+    def __init__(self, interval, groups=None):
+        self.interval = interval
+        self.groups = groups or {}
+        self.index = GroupIndex(self.groups)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _swap(self, groups):
+        merged = dict(self.groups)
+        merged.update(groups)
+        # Build before the swap, readers see the old or the new index.
+        self.index = GroupIndex(merged)
+
+    def start(self):
+        """Reloads the membership in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception:
+                # Keep polling, the next reload may succeed.
+                logger.exception('Could not reload the groups')
+            if self._stopped.wait(self.interval):
+                break
+
+
+@implementer(IGroupProvider)
+class FileGroupProvider(_PollingGroupProvider):
+    """Group membership from a JSON file, a mapping of group names to
+    lists of user ids, in addition to the ``groups`` from the settings.
+
+    Once started, the file is checked for changes every ``interval``
+    seconds by a background thread. If the file can not be read or
+    parsed, the last good membership is kept.
+    """
+
+    def __init__(self, path, interval=5, groups=None):
+        super(FileGroupProvider, self).__init__(interval, groups)
+        self.path = path
+        self._stamp = None
+        self.reload()
+
+    def reload(self):
+        """Rebuilds the index if the file has changed. Returns whether
+        the index was replaced.
+        """
+        try:
+            stamp = _file_stamp(self.path)
+            if stamp == self._stamp:
+                return False
+            # Remembered even if the file is invalid, so that it is not
+            # parsed (and logged) again until it changes.
+            self._stamp = stamp
+            # e.g. a TypeError for user ids that are not strings.
+            self._swap(_parse_groups_file(self.path))
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            logger.warning('Could not load the groups from "{}": {}'
+                           .format(self.path, exc))
+            return False
+        return True
+
+
+def parse_accounts_groups(data):
+    """Group membership from the ``/api/groups.json`` response, by group
+    name. Members are identified by username, like the logged in users.
+    """
+    groups = {}
+    for group in data:
+        if not group.get('name'):
+            continue
+        groups[group['name']] = [member['user']['username']
+                                 for member in group.get('members', [])]
+    return groups
+
+
+@implementer(IGroupProvider)
+class AccountsGroupProvider(_PollingGroupProvider):
+    """Group membership from the accounts server (``accounts`` is an
+    ``IOpenstaxAccounts`` utility), in addition to the ``groups`` from
+    the settings.
+
+    Once started, the membership is fetched every ``interval`` seconds by
+    a background thread, so permission checks never wait on accounts.
+    When a fetch fails, the last good membership is kept.
+    """
+
+    def __init__(self, accounts, interval=300, groups=None):
+        super(AccountsGroupProvider, self).__init__(interval, groups)
+        self.accounts = accounts
+        # When the membership was last fetched.
+        self.last_reload = None
+
+    def reload(self):
+        """Fetches the membership and rebuilds the index. Returns whether
+        the index was replaced.
+        """
+        try:
+            self._swap(parse_accounts_groups(
+                self.accounts.request('/api/groups.json')))
+        except Exception as exc:
+            logger.warning('Could not fetch the groups from accounts: {!r}'
+                           .format(exc))
+            return False
+        self.last_reload = time.time()
+        return True
+
+
+def get_group_index(request):
+    """The current ``GroupIndex`` of the application."""
+    provider = request.registry.queryUtility(IGroupProvider)
+    if provider is None:
+        # BBB The policy is used without including this package.
+        provider = SettingsGroupProvider(request.registry.settings)
+        request.registry.registerUtility(provider, IGroupProvider)
+    return provider.index
+
+
+def includeme(config):
+    settings = config.registry.settings
+    path = settings.get('openstax_accounts.groups_file')
+    if asbool(settings.get('openstax_accounts.groups_from_accounts')):
+        if path:
+            raise ValueError('Set either openstax_accounts.groups_file or '
+                             'openstax_accounts.groups_from_accounts')
+        if asbool(settings.get('openstax_accounts.stub')):
+            raise ValueError('openstax_accounts.groups_from_accounts is not '
+                             'available with the stub')
+        # Requires the accounts client, see ``openstax_accounts.includeme``.
+        provider = AccountsGroupProvider(
+            config.registry.getUtility(IOpenstaxAccounts),
+            interval=float(settings.get(
+                'openstax_accounts.groups_from_accounts.interval', 300)),
+            groups=parse_groups(settings))
+    elif path:
+        provider = FileGroupProvider(
+            path,
+            interval=float(settings.get(
+                'openstax_accounts.groups_file.interval', 5)),
+            groups=parse_groups(settings))
+    else:
+        config.registry.registerUtility(
+            SettingsGroupProvider(settings), IGroupProvider)
+        return
+    config.add_subscriber(lambda event: provider.start(), ApplicationCreated)
+    config.registry.registerUtility(provider, IGroupProvider)
@@ -5,7 +5,7 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
-from zope.interface import Interface
+from zope.interface import Attribute, Interface
 from pyramid.interfaces import IAuthenticationPolicy
 
 
@@ -19,8 +19,14 @@ class IOpenstaxAccounts(Interface):
     def search(query, **kwargs):
         """See ``/api/docs/v1/application_users/index``"""
 
-    def global_search(query):
-        """See ``/api/docs/v1/users/index``"""
+    def global_search(query, **kwargs):
+        """See ``/api/docs/v1/users/index``, ``kwargs`` are e.g. ``page``."""
+
+    def iter_search(query, page_size=100, prefetch=1, **kwargs):
+        """Iterates over all the users matching ``query`` (see ``search``),
+        fetching ``page_size`` users at a time. Up to ``prefetch`` pages are
+        fetched in the background while the current page is consumed.
+        """
 
     def send_message(username, subject, text_body, html_body=None):
         """Sends a single message to ``username`` with ``subject`` and
@@ -28,12 +34,26 @@ class IOpenstaxAccounts(Interface):
         See also ``/api/docs/v1/messages/create``
         """
 
+    def send_messages(usernames, subject, text_body, html_body=None):
+        """Sends a message with ``subject`` and ``text_body`` (and
+        ``html_body`` if supplied) to all of ``usernames``, using as few
+        requests as possible. Returns a mapping of each username to
+        ``True`` when its message was sent, or to the exception
+        (e.g. ``UserNotFoundException``) that prevented it.
+        """
+
     def get_profile():
         """See ``/api/docs/v1/users/show``"""
 
     def get_profile_by_username(username):
         """See ``/api/docs/v1/application_users/find_by_username``"""
 
+    def get_profiles_by_usernames(usernames, max_workers=10):
+        """Looks up the profiles of all of ``usernames``, with up to
+        ``max_workers`` concurrent requests. Returns a mapping of username
+        to profile, or ``None`` for users that were not found.
+        """
+
     def update_email(existing_emails, email):
         """ Unknown? """
 
@@ -49,6 +69,30 @@ class IOpenstaxAccountsAuthenticationPolicy(IAuthenticationPolicy):
     # this interface is need.
 
 
+class IProfileStore(Interface):
+    """Server-side storage of the logged in users' profiles."""
+
+    def get(key):
+        """Returns ``(version, profile)`` for ``key``, or ``(None, None)``
+        if there is no such profile.
+        """
+
+    def set(key, profile):
+        """Saves ``profile`` under ``key`` and returns its new version."""
+
+    def delete(key):
+        """Removes the profile saved under ``key``."""
+
+
+class IGroupProvider(Interface):
+    """Source of the group membership used by the authentication
+    policies.
+    """
+
+    index = Attribute("The current ``groups.GroupIndex``, replaced "
+                      "(never modified) when the membership changes.")
+
+
 class IMessageSender(Interface):
     """Utility for sending messages"""
 
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Instrumentation of the requests made to the accounts server.
+
+Every request is recorded with ``Metrics.record``, which keeps per
+endpoint latency and response size histograms and error counts (see
+``Metrics.snapshot``), and passes the measurement on to the sinks, e.g.
+``LoggingSink`` or ``StatsdSink``. Failed requests are timed in their own
+histogram and requests that were not sent (e.g. stopped by the circuit
+breaker) are only counted as errors, so that an outage does not make the
+latency look good.
+"""
+import bisect
+import logging
+import socket
+import threading
+
+
+__all__ = (
+    'Histogram', 'LoggingSink', 'Metrics', 'StatsdSink',
+    'make_metrics',
+    )
+
+
+# Upper bounds of the latency buckets in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the response size buckets in bytes.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+    """Counts of the observed values per bucket, where ``bounds`` are the
+    (sorted) upper bounds of the buckets. Values above the last bound go
+    into an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket the ``percent`` percentile falls in,
+        or the maximum value for the overflow bucket.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': dict(zip(self.bounds + ('+Inf',), self.counts)),
+            }
+
+
+class _EndpointMetrics(object):
+
+    def __init__(self):
+        # Of the successful requests.
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        # Of the failed requests.
+        self.error_latency = Histogram(LATENCY_BUCKETS)
+        self.errors = {}
+
+    def snapshot(self):
+        return {
+            'requests': self.latency.count + self.error_latency.count,
+            'errors': dict(self.errors),
+            'latency': self.latency.snapshot(),
+            'error_latency': self.error_latency.snapshot(),
+            'size': self.size.snapshot(),
+            }
+
+
+class Metrics(object):
+    """Thread-safe, in-memory aggregation of the accounts requests."""
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, size=0, error=None):
+        """Records a request to ``endpoint`` that took ``seconds`` and
+        returned ``size`` bytes. ``error`` is the name of the error
+        (e.g. ``'HTTPError 404'`` or ``'timeout'``) if the request failed.
+        ``seconds`` is ``None`` if the request was not sent.
+        """
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = _EndpointMetrics()
+            if error is None:
+                metrics.latency.observe(seconds)
+                metrics.size.observe(size)
+            else:
+                if seconds is not None:
+                    metrics.error_latency.observe(seconds)
+                metrics.errors[error] = metrics.errors.get(error, 0) + 1
+        for sink in self.sinks:
+            sink.record(endpoint, seconds, size, error)
+
+    def snapshot(self):
+        """The metrics collected so far, by endpoint."""
+        with self._lock:
+            return dict((endpoint, metrics.snapshot())
+                        for endpoint, metrics in self._endpoints.items())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+class LoggingSink(object):
+    """Logs every request."""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('openstax-accounts')
+        self.level = level
+
+    def record(self, endpoint, seconds, size, error):
+        if seconds is None:
+            self.logger.log(self.level, 'accounts %s not sent (%s)',
+                            endpoint, error)
+            return
+        self.logger.log(
+            self.level, 'accounts %s took %.1fms, %d bytes%s',
+            endpoint, seconds * 1000, size,
+            error and ' ({})'.format(error) or '')
+
+
+class StatsdSink(object):
+    """Sends every request to a statsd server over UDP."""
+
+    def __init__(self, host='localhost', port=8125,
+                 prefix='openstax_accounts'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, endpoint, seconds, size, error):
+        name = '{}.{}'.format(self.prefix, endpoint)
+        lines = []
+        if seconds is not None:
+            lines.append('{}.requests:1|c'.format(name))
+        if error is None:
+            lines.extend([
+                '{}.latency:{:.3f}|ms'.format(name, seconds * 1000),
+                '{}.size:{}|h'.format(name, size),
+                ])
+        else:
+            if seconds is not None:
+                lines.append('{}.error_latency:{:.3f}|ms'.format(
+                    name, seconds * 1000))
+            lines.append('{}.errors:1|c'.format(name))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'),
+                               self.address)
+        except socket.error:
+            # Metrics must never break the requests.
+            pass
+
+
+def make_metrics(settings):
+    """Creates ``Metrics`` from the (local) ``metrics.*`` settings.
+    ``metrics.sinks`` is a list of ``log`` and ``statsd``, the in-memory
+    snapshot is always available.
+    """
+    sinks = []
+    for name in settings.get('metrics.sinks', '').split():
+        if name == 'log':
+            sinks.append(LoggingSink())
+        elif name == 'statsd':
+            sinks.append(StatsdSink(
+                host=settings.get('metrics.statsd_host', 'localhost'),
+                port=settings.get('metrics.statsd_port', 8125),
+                prefix=settings.get('metrics.statsd_prefix',
+                                    'openstax_accounts')))
+        else:
+            raise ValueError('Unknown metrics sink "{}"'.format(name))
+    return Metrics(sinks)
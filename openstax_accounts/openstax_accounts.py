@@ -1,24 +1,48 @@
 # -*- coding: utf-8 -*-
-import cgi
+import atexit
+import copy
 import json
 import logging
-import urllib
 import pprint
+import socket
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as queue # python2
+except ImportError:
+    import queue # renamed in python3
 try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode # python3
+try:
+    from html import escape # python3
+except ImportError:
+    from cgi import escape # removed in python3.8
 try:
     import urlparse # python2
 except ImportError:
     import urllib.parse as urlparse # renamed in python3
+try:
+    import httplib # python2
+except ImportError:
+    import http.client as httplib # renamed in python3
 
 import sanction
+from pyramid.events import ApplicationCreated
+from pyramid.settings import asbool
 from pyramid.threadlocal import get_current_registry
 from zope.interface import implementer
 
+from .cache import MISSING, TTLCache
 from .interfaces import *
-from .utils import local_settings
+from .metrics import Metrics, make_metrics
+from .profile_store import remember_profile
+from .resilience import CircuitBreaker, CircuitOpenError, backoff, hedged
+from .transport import HTTPError, Transport, DEFAULT_POOL_SIZE
+from .utils import chunked, local_settings, prefetched
 
 logger = logging.getLogger('openstax-accounts')
 
@@ -36,10 +60,194 @@ def parser_remove_null_expires_in(data):
     return data
 
 
+def add_access_token(url, access_token):
+    """Adds the ``access_token`` to the query string of ``url``, the same
+    way ``sanction.transport_query`` does.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urlparse.parse_qsl(parts.query)
+    query.append(('access_token', access_token))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path,
+                                urlencode(query), parts.fragment))
+
+
+# Names of the accounts API endpoints by path (prefix), used to configure
+# their timeouts.
+ENDPOINTS = (
+    ('/oauth/token', 'token'),
+    ('/api/application_users/find/username/', 'profile_by_username'),
+    ('/api/application_users.json', 'search'),
+    ('/api/users.json', 'global_search'),
+    ('/api/user.json', 'profile'),
+    ('/api/messages.json', 'messages'),
+    ('/api/contact_infos', 'contact_infos'),
+    ('/api/groups', 'groups'),
+    )
+
+
+def endpoint_name(url):
+    """Name of the accounts API endpoint ``url`` (a path or a full url)
+    belongs to, see ``ENDPOINTS``.
+    """
+    # The resource urls are joined with a double slash, e.g.
+    # ``https://accounts.example.com//api/user.json``.
+    path = '/' + urlparse.urlsplit(url).path.lstrip('/')
+    for prefix, name in ENDPOINTS:
+        if path.startswith(prefix):
+            return name
+    return 'other'
+
+
+def normalize_query(query):
+    """Trims and collapses the whitespace in a search query."""
+    return ' '.join(query.split())
+
+
+def normalize_order_by(order_by):
+    """Canonical form of an ``order_by`` value, e.g.
+    ``'first_name, last_name desc'`` becomes
+    ``'first_name ASC,last_name DESC'``.
+    """
+    clauses = []
+    for clause in order_by.split(','):
+        parts = clause.split()
+        if not parts:
+            continue
+        direction = parts[1].upper() if len(parts) > 1 else 'ASC'
+        clauses.append('{} {}'.format(parts[0], direction))
+    return ','.join(clauses)
+
+
+def search_cache_key(endpoint, query, kwargs, access_token=None):
+    """Key of a search result in ``OpenstaxAccounts.search_cache``.
+    Results are not shared between access tokens, because what a search
+    returns can depend on who is searching.
+    """
+    kwargs = dict(kwargs)
+    if kwargs.get('order_by'):
+        kwargs['order_by'] = normalize_order_by(kwargs['order_by'])
+    return (endpoint, normalize_query(query),
+            tuple(sorted((k, str(v)) for k, v in kwargs.items())),
+            access_token)
+
+
+def json_size(value):
+    """Approximate size of ``value`` in bytes, as encoded in JSON."""
+    return len(json.dumps(value))
+
+
+def build_message_data(userids, subject, text_body, html_body=None):
+    """Builds the ``/api/messages.json`` payload for ``userids``,
+    a single user id or a list of user ids.
+    """
+    if not isinstance(userids, (list, tuple)):
+        userids = [userids]
+    userids = [int(userid) for userid in userids]
+    if html_body is None:
+        html_body = '<html><body>{}</body></html>'.format(
+            escape(text_body, quote=False).replace('\n', '\n<br/>'))
+
+    return {
+        'user_id': userids[0],
+        'to[user_ids][]': userids,
+        'subject': subject,
+        'body[text]': text_body,
+        'body[html]': html_body,
+        }
+
+
+def lookup_userid(accounts, username):
+    """Finds the id of the user with ``username`` using
+    ``accounts.global_search``.
+    """
+    userid = resolve_userids(accounts, [username]).get(username)
+    if userid is None:
+        raise UserNotFoundException('User "{}" not found'.format(username))
+    return userid
+
+
+def more_userid_pages(results, seen, wanted):
+    """Whether the ``global_search`` for the ``wanted`` usernames has more
+    pages, ``seen`` users having been returned so far.
+    Searches match usernames by prefix, so other users can fill the
+    first pages.
+    """
+    total = results.get('total_count')
+    return bool(wanted and results['items'] and total is not None
+                and seen < total)
+
+
+def resolve_userids(accounts, usernames, batch_size=50):
+    """Maps ``usernames`` to user ids using ``accounts.userid_cache`` and a
+    ``global_search`` for every ``batch_size`` uncached usernames, paging
+    through the results until all of them are found.
+    Usernames that are not found are left out of the result.
+    """
+    userids = {}
+    unresolved = []
+    for username in usernames:
+        userid = accounts.userid_cache.get(username)
+        if userid is MISSING:
+            unresolved.append(username)
+        else:
+            userids[username] = userid
+    for batch in chunked(unresolved, batch_size):
+        wanted = set(batch)
+        query = 'username:{}'.format(','.join(batch))
+        page = 1
+        seen = 0
+        while True:
+            if page == 1:
+                users = accounts.global_search(query)
+            else:
+                users = accounts.global_search(query, page=page)
+            for user in users['items']:
+                if user['username'] in wanted:
+                    wanted.discard(user['username'])
+                    userids[user['username']] = user['id']
+                    accounts.userid_cache.set(user['username'], user['id'])
+            seen += len(users['items'])
+            if not more_userid_pages(users, seen, wanted):
+                break
+            page += 1
+    return userids
+
+
+def email_addresses(profile):
+    """The email addresses among the contact infos of ``profile``."""
+    return [info['value'] for info in profile.get('contact_infos', [])
+            if info['type'] == 'EmailAddress']
+
+
+def parse_update_response(text):
+    """The updated profile from the body of a ``PUT /api/user.json``
+    response, or ``None`` when the response has no profile (204).
+    """
+    try:
+        profile = json.loads(text)
+    except ValueError:
+        return None
+    return profile if isinstance(profile, dict) else None
+
+
+def merge_profile(profile, post_data, contact_info=None):
+    """``profile`` updated locally with ``post_data`` and the
+    ``contact_info`` created by ``update_email``.
+    """
+    profile = dict(profile)
+    profile.update((key, value) for key, value in post_data.items()
+                   if key != 'email')
+    if contact_info is not None:
+        profile['contact_infos'] = (list(profile.get('contact_infos', []))
+                                    + [contact_info])
+    return profile
+
+
 @implementer(IMessageSender)
-def send_message(msg_data):
+def send_message(msg_data, registry=None):
     """Send the message using the accounts request."""
-    accounts = get_current_registry().getUtility(IOpenstaxAccounts)
+    registry = registry or get_current_registry()
+    accounts = registry.getUtility(IOpenstaxAccounts)
     accounts.request('/api/messages.json', data=urlencode(msg_data, True))
 
 
@@ -50,13 +258,353 @@ def log_message(msg_data):
     logger.info("Captured message:\n\n{}".format(msg_data_as_str))
 
 
+# Put on the queue to tell a ``QueuedMessageSender`` worker to exit.
+_STOP_WORKER = object()
+
+
+@implementer(IMessageSender)
+class QueuedMessageSender(object):
+    """Sends messages from a pool of background worker threads, so the
+    caller does not wait on the accounts server.
+
+    Messages are put on a queue of at most ``queue_size`` messages. When
+    the queue is full and ``block`` is true the caller waits (for at most
+    ``block_timeout`` seconds, if given) for room on the queue, otherwise
+    the message is dropped. Because sending happens later, errors
+    (including a rejected recipient) are logged rather than raised.
+    """
+
+    def __init__(self, send=send_message, workers=2, queue_size=1000,
+                 block=True, block_timeout=None):
+        self.send = send
+        self.block = block
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(queue_size)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(
+                target=self._work,
+                name='openstax-accounts-sender-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __call__(self, msg_data):
+        if self._closed:
+            raise RuntimeError('The message sender has been closed')
+        try:
+            self.queue.put(msg_data, self.block, self.block_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning('Message queue full, dropped message "{}"'
+                           .format(msg_data.get('subject')))
+
+    def _work(self):
+        while True:
+            msg_data = self.queue.get()
+            try:
+                if msg_data is _STOP_WORKER:
+                    return
+                start = time.time()
+                try:
+                    self.send(msg_data)
+                except Exception:
+                    logger.exception('Failed to send message "{}"'
+                                     .format(msg_data.get('subject')))
+                    failed = 1
+                else:
+                    failed = 0
+                latency = time.time() - start
+                with self._lock:
+                    self.sent += 1 - failed
+                    self.failed += failed
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+            finally:
+                self.queue.task_done()
+
+    def close(self, timeout=None):
+        """Stops accepting messages, sends the queued messages and stops
+        the workers, waiting at most ``timeout`` seconds for each worker.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            self.queue.put(_STOP_WORKER)
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self):
+        """Counters for monitoring the queue and the sending latency."""
+        with self._lock:
+            attempts = self.sent + self.failed
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'workers': len(self._workers),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'latency_avg': attempts and self.latency_total / attempts,
+                'latency_max': self.latency_max,
+                }
+
+
+class ApplicationToken(object):
+    """The application's (client credentials) access token.
+
+    The token is fetched when first needed, or in the background after
+    ``start`` is called, and refreshed ``refresh_margin`` seconds before
+    it expires. Only one fetch happens at a time, concurrent callers wait
+    for it or keep using the current token while it is still valid.
+    """
+
+    def __init__(self, accounts, refresh_margin=60):
+        self.accounts = accounts
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        # Time the token expires at, ``None`` if it does not expire.
+        self.expires = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _is_fresh(self, margin):
+        return self.access_token is not None and (
+            self.expires is None or time.time() < self.expires - margin)
+
+    def get(self):
+        """Returns a valid access token, fetching one if need be."""
+        if self._is_fresh(self.refresh_margin):
+            return self.access_token
+        if self._is_fresh(0):
+            # Refresh early, unless someone else is already refreshing.
+            if not self._lock.acquire(False):
+                return self.access_token
+        else:
+            self._lock.acquire()
+        try:
+            if not self._is_fresh(self.refresh_margin):
+                self._fetch()
+        finally:
+            self._lock.release()
+        return self.access_token
+
+    def refresh(self, rejected_token=None):
+        """Fetches a new token, unless the token was already replaced
+        since ``rejected_token`` was handed out.
+        """
+        with self._lock:
+            if rejected_token is None or rejected_token == self.access_token:
+                self._fetch()
+        return self.access_token
+
+    def _fetch(self):
+        data = self.accounts._fetch_token(grant_type='client_credentials')
+        expires_in = data.get('expires_in')
+        self.expires = expires_in and time.time() + expires_in or None
+        self.access_token = data['access_token']
+
+    def start(self):
+        """Fetches and refreshes the token from a background thread."""
+        thread = threading.Thread(target=self._run,
+                                  name='openstax-accounts-token')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                self.get()
+            except Exception:
+                logger.exception('Failed to fetch the application token')
+                self._stopped.wait(delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = 1
+            if self.expires is None:
+                return
+            self._stopped.wait(
+                max(self.expires - self.refresh_margin - time.time(), 1))
+
+
+class BaseOpenstaxAccounts(object):
+    """What the blocking and the asyncio (see ``aio``) clients share: how
+    the requests are timed out, retried, recorded in the metrics and
+    stopped by the circuit breaker, the conditional GET requests and the
+    profile cache.
+    """
+
+    def _timeout(self, name):
+        """The timeout of the requests to the endpoint ``name``."""
+        timeouts = self.timeouts
+        return timeouts.get(name, timeouts.get(None))
+
+    def _attempts(self, method):
+        # Only GET requests are retried, the others have side effects.
+        return 1 + (self.retries if method == 'GET' else 0)
+
+    def _allow_request(self, name):
+        """Fails fast with ``CircuitOpenError`` while the accounts server
+        is unhealthy.
+        """
+        if not self.circuit_breaker.allow():
+            self.metrics.record(name, None, error='circuit_open')
+            raise CircuitOpenError('The accounts server is unavailable')
+
+    def _record_success(self, name, seconds, response):
+        self.metrics.record(name, seconds, len(response.data))
+        self.circuit_breaker.record_success()
+
+    def _record_failure(self, name, seconds, exc):
+        """Records a failed attempt. Returns whether the request may be
+        retried.
+        """
+        if isinstance(exc, HTTPError):
+            self.metrics.record(name, seconds,
+                                error='HTTP {}'.format(exc.code))
+            if exc.code < 500:
+                # The server is healthy, the request is at fault.
+                self.circuit_breaker.record_success()
+                return False
+        else:
+            self.metrics.record(name, seconds, error=type(exc).__name__)
+        self.circuit_breaker.record_failure()
+        return True
+
+    def _retry_after(self, attempt, attempts):
+        """Seconds to wait before the next attempt, ``None`` if there is
+        none.
+        """
+        if attempt + 1 == attempts or not self.circuit_breaker.allow():
+            return None
+        return backoff(attempt, base=self.retry_backoff)
+
+    def _conditional_headers(self, key, headers):
+        """The cached validators and result of the conditional request
+        ``key``, and the ``headers`` with the validators.
+        """
+        cached = self.conditional_cache.get(key)
+        headers = dict(headers or {})
+        if cached is not MISSING:
+            etag, last_modified, result = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return cached, headers
+
+    def _conditional_result(self, key, cached, response, parser):
+        # Callers get copies, e.g. the profile ends up in the session.
+        if response.status == 304 and cached is not MISSING:
+            return copy.deepcopy(cached[2])
+        result = parser(response.text)
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if etag or last_modified:
+            self.conditional_cache.set(
+                key, (etag, last_modified, copy.deepcopy(result)))
+        else:
+            self.conditional_cache.invalidate(key)
+        return result
+
+    def _profile_path(self, username):
+        return '/api/application_users/find/username/{}'.format(username)
+
+    def _profile_key(self, username):
+        # Applications and users may be allowed to see different profiles.
+        return (self._searcher, username)
+
+    def _cached_profile(self, username):
+        """A copy of the cached profile of ``username``, or ``MISSING``."""
+        profile = self.profile_cache.get(self._profile_key(username))
+        if profile is MISSING:
+            return profile
+        return copy.deepcopy(profile)
+
+    def _profile_found(self, username, profile):
+        self.profile_cache.set(self._profile_key(username), profile)
+        return copy.deepcopy(profile)
+
+    def _profile_not_found(self, username, exc):
+        """The profile of ``username`` when it could not be fetched."""
+        key = self._profile_key(username)
+        if isinstance(exc, HTTPError) and exc.code == 404:
+            self.profile_cache.set(key, None, ttl=self.profile_miss_ttl)
+            return None
+        # Serve the last known profile when the server can not be reached.
+        profile = self.profile_cache.get_stale(key)
+        if profile is MISSING:
+            return None
+        return copy.deepcopy(profile)
+
+    def _forget_profiles(self, usernames):
+        """Drops the cached profiles of ``usernames``, for everyone."""
+        usernames = set(username for username in usernames if username)
+        self.profile_cache.invalidate_if(lambda key: key[1] in usernames)
+
+
 @implementer(IOpenstaxAccounts)
-class OpenstaxAccounts(object):
+class OpenstaxAccounts(BaseOpenstaxAccounts):
 
     server_url = None
     application_id = None
     application_secret = None
     application_url = None
+    # Process-wide connection pool, see ``singleton``.
+    transport = None
+    # Process-wide cache of ``get_profile_by_username`` results and the
+    # number of seconds a "user not found" result is cached for.
+    profile_cache = None
+    profile_miss_ttl = 30
+    # Process-wide cache of username to user id, used by ``send_message``.
+    userid_cache = None
+    # Number of usernames looked up per search and number of recipients
+    # per message in ``send_messages``.
+    lookup_batch_size = 50
+    message_batch_size = 100
+    # Process-wide pool of threads running the ``get_profiles_by_usernames``
+    # lookups, started when first needed. Its size caps the number of
+    # concurrent lookups across all the threads of the process.
+    lookup_pool = None
+    lookup_concurrency = DEFAULT_POOL_SIZE
+    _lookup_pool_lock = threading.Lock()
+    # Process-wide cache of ``search`` and ``global_search`` results,
+    # bounded by the (JSON encoded) size of the results.
+    search_cache = None
+    # Socket timeouts in seconds by endpoint name (see ``ENDPOINTS``),
+    # ``None`` is the default for all the endpoints.
+    timeouts = {None: 10}
+    # Number of times a failed GET is retried and the base delay in
+    # seconds between the retries.
+    retries = 2
+    retry_backoff = 0.1
+    # When set, a second ``get_profile_by_username`` request is sent if
+    # the first one has not returned after this many seconds.
+    hedge_after = None
+    # Process-wide cache of the validators and results of conditional
+    # GET requests, by URL and access token.
+    conditional_cache = None
+    # Process-wide circuit breaker for the accounts server.
+    circuit_breaker = None
+    # Process-wide latency, size and error metrics by endpoint,
+    # see ``metrics.Metrics``.
+    metrics = None
+    # When set, requests are made with the application's token,
+    # see ``ApplicationToken``.
+    application_token = None
 
     def __init__(self, server_url=None, application_id=None,
                  application_secret=None, application_url=None):
@@ -68,6 +616,20 @@ class OpenstaxAccounts(object):
             self.application_secret = application_secret
         if application_url:
             self.application_url = application_url
+        if self.transport is None:
+            self.transport = Transport()
+        if self.profile_cache is None:
+            self.profile_cache = TTLCache()
+        if self.userid_cache is None:
+            self.userid_cache = TTLCache()
+        if self.search_cache is None:
+            self.search_cache = TTLCache(ttl=0)
+        if self.conditional_cache is None:
+            self.conditional_cache = TTLCache(ttl=3600)
+        if self.circuit_breaker is None:
+            self.circuit_breaker = CircuitBreaker()
+        if self.metrics is None:
+            self.metrics = Metrics()
 
         resource_url = self.server_url
         authorize_url = urlparse.urljoin(self.server_url, '/oauth/authorize')
@@ -88,9 +650,75 @@ class OpenstaxAccounts(object):
         cls.application_id = settings['application_id']
         cls.application_secret = settings['application_secret']
         cls.application_url = settings['application_url']
+        if cls.transport is not None:
+            cls.transport.close()
+        cls.transport = Transport(
+            pool_size=int(settings.get('pool_size', DEFAULT_POOL_SIZE)),
+            verify_ssl=not asbool(settings.get('disable_verify_ssl')))
+        cls.profile_cache = TTLCache(
+            maxsize=int(settings.get('profile_cache.size', 1024)),
+            ttl=float(settings.get('profile_cache.ttl', 300)))
+        cls.profile_miss_ttl = float(
+            settings.get('profile_cache.miss_ttl', 30))
+        cls.userid_cache = TTLCache(
+            maxsize=int(settings.get('userid_cache.size', 4096)),
+            ttl=float(settings.get('userid_cache.ttl', 3600)))
+        cls.search_cache = TTLCache(
+            maxsize=int(settings.get('search_cache.size', 1024)),
+            ttl=float(settings.get('search_cache.ttl', 30)),
+            maxbytes=int(settings.get('search_cache.max_bytes',
+                                      10 * 1024 * 1024)),
+            sizeof=json_size)
+        cls.conditional_cache = TTLCache(
+            maxsize=int(settings.get('conditional_cache.size', 1024)),
+            ttl=float(settings.get('conditional_cache.ttl', 3600)))
+        cls.timeouts = {None: float(settings.get('timeout', 10))}
+        cls.timeouts.update(
+            (name, float(value)) for name, value
+            in local_settings(settings, prefix='timeout').items())
+        cls.retries = int(settings.get('retries', 2))
+        cls.retry_backoff = float(settings.get('retry_backoff', 0.1))
+        hedge_after = settings.get('hedge_after')
+        cls.hedge_after = hedge_after and float(hedge_after) or None
+        cls.circuit_breaker = CircuitBreaker(
+            failure_threshold=int(settings.get(
+                'circuit_breaker.failure_threshold', 5)),
+            reset_timeout=float(settings.get(
+                'circuit_breaker.reset_timeout', 30)))
+        cls.metrics = make_metrics(settings)
+        with cls._lookup_pool_lock:
+            if cls.lookup_pool is not None:
+                # The running lookups finish, then its threads exit.
+                cls.lookup_pool.close()
+                cls.lookup_pool = None
+            cls.lookup_concurrency = max(1, int(settings.get(
+                'lookup_concurrency', cls.transport.pool_size)))
+        cls.lookup_batch_size = int(settings.get('lookup_batch_size', 50))
+        cls.message_batch_size = int(settings.get('message_batch_size', 100))
+
+    def bind(self, access_token=None):
+        """Returns a client that shares the endpoints, credentials, caches
+        and connection pool with this one, but carries its own (user's)
+        ``access_token``. Much cheaper than creating a new client, e.g.
+        once per request.
+        """
+        client = object.__new__(self.__class__)
+        client.__dict__.update(self.__dict__)
+        client.application_token = None
+        parent = self.sanction_client
+        client.sanction_client = sanction.Client(
+                auth_endpoint=parent.auth_endpoint,
+                token_endpoint=parent.token_endpoint,
+                resource_endpoint=parent.resource_endpoint,
+                client_id=parent.client_id,
+                client_secret=parent.client_secret)
+        client.sanction_client.access_token = access_token
+        return client
 
     @property
     def access_token(self):
+        if self.application_token is not None:
+            return self.application_token.access_token
         return self.sanction_client.access_token
 
     @access_token.setter
@@ -100,89 +728,371 @@ class OpenstaxAccounts(object):
     def auth_uri(self):
         return self.sanction_client.auth_uri(redirect_uri=self.redirect_uri)
 
+    def _fetch_token(self, **kwargs):
+        """Requests a token from the token endpoint and returns the
+        parsed response.
+        """
+        client = self.sanction_client
+        kwargs.update({
+            'client_id': client.client_id,
+            'client_secret': client.client_secret,
+            })
+        kwargs.setdefault('grant_type', 'authorization_code')
+        response = self._send('POST', client.token_endpoint,
+                              urlencode(kwargs), None)
+        return parser_remove_null_expires_in(response.text)
+
+    def _send(self, method, url, data, headers):
+        """Sends the request through the transport, with the endpoint's
+        timeout, retrying failed GET requests. Fails fast with
+        ``CircuitOpenError`` while the accounts server is unhealthy.
+        """
+        name = endpoint_name(url)
+        self._allow_request(name)
+        timeout = self._timeout(name)
+        attempts = self._attempts(method)
+        for attempt in range(attempts):
+            start = time.time()
+            try:
+                response = self.transport.request(
+                    method, url, body=data, headers=headers, timeout=timeout)
+            except (HTTPError, socket.error, httplib.HTTPException) as exc:
+                if not self._record_failure(name, time.time() - start, exc):
+                    raise
+                error = exc
+            else:
+                self._record_success(name, time.time() - start, response)
+                return response
+            delay = self._retry_after(attempt, attempts)
+            if delay is None:
+                break
+            time.sleep(delay)
+        raise error
+
+    def _request_token(self, **kwargs):
+        """Same as ``sanction.Client.request_token``, but sent
+        through the pooled transport.
+        """
+        client = self.sanction_client
+        data = self._fetch_token(**kwargs)
+        for key in data:
+            setattr(client, key, data[key])
+        if 'expires_in' in data:
+            client.token_expires = time.time() + data['expires_in']
+
     def request_token_with_code(self, code):
-        self.sanction_client.request_token(
-                code=code,
-                redirect_uri=self.redirect_uri,
-                parser=parser_remove_null_expires_in)
+        self._request_token(code=code, redirect_uri=self.redirect_uri)
 
     def request_application_token(self):
-        self.sanction_client.request_token(
-                grant_type='client_credentials',
-                parser=parser_remove_null_expires_in)
+        if self.application_token is not None:
+            self.application_token.refresh()
+        else:
+            self._request_token(grant_type='client_credentials')
+
+    def request(self, url, method=None, data=None, headers=None,
+                parser=None, conditional=False):
+        """Request a resource from the accounts server, see
+        ``sanction.Client.request``. ``conditional`` GET requests send the
+        validators (``ETag``, ``Last-Modified``) of the previous response,
+        and return the previous (shared) result when it is not modified.
+        """
+        parser = parser or json.loads
+        if not method:
+            method = 'GET' if not data else 'POST'
+        url = '{}{}'.format(self.sanction_client.resource_endpoint, url)
+        conditional = conditional and method == 'GET'
+        if self.application_token is None:
+            assert self.access_token is not None
+            return self._request(method, url, self.access_token, data,
+                                 headers, parser, conditional)
+
+        access_token = self.application_token.get()
+        try:
+            return self._request(method, url, access_token, data, headers,
+                                 parser, conditional)
+        except HTTPError as exc:
+            if exc.code != 401:
+                raise
+            # The token was revoked or expired early, get a new one.
+            access_token = self.application_token.refresh(access_token)
+            return self._request(method, url, access_token, data, headers,
+                                 parser, conditional)
+
+    def _request(self, method, url, access_token, data, headers, parser,
+                 conditional):
+        if not conditional:
+            response = self._send(method, add_access_token(url, access_token),
+                                  data, headers)
+            return parser(response.text)
 
-    def request(self, *args, **kwargs):
-        return self.sanction_client.request(*args, **kwargs)
+        # Responses are specific to the user, so are the validators.
+        key = (url, access_token)
+        cached, headers = self._conditional_headers(key, headers)
+        response = self._send(method, add_access_token(url, access_token),
+                              data, headers)
+        return self._conditional_result(key, cached, response, parser)
+
+    @property
+    def _searcher(self):
+        """Who the searches are made as, see ``search_cache_key``."""
+        if self.application_token is not None:
+            return 'application'
+        return self.access_token
 
     def search(self, query, **kwargs):
-        kwargs['q'] = query
+        key = search_cache_key('search', query, kwargs, self._searcher)
+        return self._cached_search(key, lambda: self._search(query, kwargs))
+
+    def _search(self, query, kwargs):
+        kwargs = dict(kwargs, q=query)
         return self.request('/api/application_users.json?{}'.format(
             urlencode(kwargs)))
 
-    def global_search(self, query):
-        return self.request('/api/users.json?{}'.format(
-            urlencode({'q': query})))
+    def global_search(self, query, **kwargs):
+        key = search_cache_key('global_search', query, kwargs,
+                               self._searcher)
+        return self._cached_search(key, lambda: self.request(
+            '/api/users.json?{}'.format(urlencode(dict(kwargs, q=query)))))
+
+    def _cached_search(self, key, fetch):
+        """A copy of the cached results for ``key``, fetched when missing,
+        so that callers can not modify the cached results.
+        """
+        results = self.search_cache.get(key)
+        if results is MISSING:
+            results = fetch()
+            self.search_cache.set(key, results)
+        return copy.deepcopy(results)
+
+    def invalidate_search_cache(self, query=None):
+        """Drops the cached ``search`` and ``global_search`` results for
+        ``query``, with any other arguments, or all of them when no
+        ``query`` is given.
+        """
+        if query is None:
+            self.search_cache.clear()
+        else:
+            query = normalize_query(query)
+            self.search_cache.invalidate_if(lambda key: key[1] == query)
+
+    def iter_search(self, query, page_size=100, prefetch=1, **kwargs):
+        # The pages are not cached, a walk through all the results would
+        # push the frequent searches out of the search cache.
+        def pages():
+            per_page = page_size
+            page = 1
+            seen = 0
+            while True:
+                results = self._search(
+                    query, dict(kwargs, page=page, per_page=per_page))
+                items = results['items']
+                yield items
+                seen += len(items)
+                total = results.get('total_count')
+                if total is None:
+                    if len(items) < per_page:
+                        return
+                elif seen >= total or not items:
+                    return
+                elif page == 1 and len(items) < per_page:
+                    # The server caps the page size.
+                    per_page = len(items)
+                page += 1
+
+        for items in prefetched(pages(), prefetch):
+            for item in items:
+                yield item
 
     def send_message(self, username, subject, text_body, html_body=None):
-        users = self.global_search('username:{}'.format(username))
-        userid = None
-        for user in users['items']:
-            if user['username'] == username:
-                userid = user['id']
-        if userid is None:
-            raise UserNotFoundException('User "{}" not found'.format(username))
-
-        if html_body is None:
-            html_body = '<html><body>{}</body></html>'.format(
-                cgi.escape(text_body).replace('\n', '\n<br/>'))
-
-        msg_data = {
-            'user_id': int(userid),
-            'to[user_ids][]': [int(userid)],
-            'subject': subject,
-            'body[text]': text_body,
-            'body[html]': html_body,
-            }
+        userid = self.userid_cache.get(username)
+        cached = userid is not MISSING
+        if not cached:
+            userid = lookup_userid(self, username)
+            self.userid_cache.set(username, userid)
 
         send_msg_util = get_current_registry().getUtility(IMessageSender)
-        send_msg_util(msg_data)
+        try:
+            send_msg_util(build_message_data(
+                userid, subject, text_body, html_body))
+        except HTTPError as exc:
+            if not cached or exc.code >= 500:
+                raise
+            # The server rejected the cached user id, which may be stale.
+            # Look the user up again and retry with the fresh id.
+            self.userid_cache.invalidate(username)
+            self.invalidate_search_cache('username:{}'.format(username))
+            userid = lookup_userid(self, username)
+            self.userid_cache.set(username, userid)
+            send_msg_util(build_message_data(
+                userid, subject, text_body, html_body))
+
+    def send_messages(self, usernames, subject, text_body, html_body=None):
+        usernames = list(OrderedDict.fromkeys(usernames))
+        userids = resolve_userids(self, usernames, self.lookup_batch_size)
+        results = {}
+        for username in usernames:
+            if username not in userids:
+                results[username] = UserNotFoundException(
+                    'User "{}" not found'.format(username))
+
+        send_msg_util = get_current_registry().getUtility(IMessageSender)
+        found = [username for username in usernames if username in userids]
+        for batch in chunked(found, self.message_batch_size):
+            results.update(self._send_batch(
+                send_msg_util, batch, userids,
+                subject, text_body, html_body))
+        return results
+
+    def _send_batch(self, send_msg_util, usernames, userids,
+                    subject, text_body, html_body, retry=True):
+        try:
+            send_msg_util(build_message_data(
+                [userids[username] for username in usernames],
+                subject, text_body, html_body))
+        except HTTPError as exc:
+            if not retry or exc.code >= 500:
+                return dict((username, exc) for username in usernames)
+            # The server rejected one of the user ids, which may be stale.
+            # Look the users up again and retry with the fresh ids.
+            for username in usernames:
+                self.userid_cache.invalidate(username)
+            self.search_cache.invalidate_if(
+                lambda key: key[1].startswith('username:'))
+            userids = resolve_userids(self, usernames, self.lookup_batch_size)
+            results = {}
+            for username in usernames:
+                if username not in userids:
+                    results[username] = UserNotFoundException(
+                        'User "{}" not found'.format(username))
+            found = [username for username in usernames
+                     if username in userids]
+            if found:
+                results.update(self._send_batch(
+                    send_msg_util, found, userids,
+                    subject, text_body, html_body, retry=False))
+            return results
+        except Exception as exc:
+            return dict((username, exc) for username in usernames)
+        return dict((username, True) for username in usernames)
 
     def get_profile(self):
-        return self.request('/api/user.json')
+        return self.request('/api/user.json', conditional=True)
 
     def get_profile_by_username(self, username):
-        path = '/api/application_users/find/username/{}'.format(username)
+        profile = self._cached_profile(username)
+        if profile is MISSING:
+            profile = self._fetch_profile_by_username(username)
+        return profile
+
+    def _fetch_profile_by_username(self, username):
+        path = self._profile_path(username)
         try:
-            return self.request(path)['user']
-        except:
-            return None
+            if self.hedge_after:
+                profile = hedged(
+                    lambda: self.request(path, conditional=True),
+                    self.hedge_after)['user']
+            else:
+                profile = self.request(path, conditional=True)['user']
+        except Exception as exc:
+            return self._profile_not_found(username, exc)
+        return self._profile_found(username, profile)
+
+    def get_profiles_by_usernames(self, usernames, max_workers=10):
+        profiles = {}
+        uncached = []
+        for username in OrderedDict.fromkeys(usernames):
+            profile = self._cached_profile(username)
+            if profile is MISSING:
+                uncached.append(username)
+            else:
+                profiles[username] = profile
+        if not uncached:
+            return profiles
+
+        # Each worker looks up its share of the usernames one at a time,
+        # so that at most ``max_workers`` of the pool's threads are used.
+        workers = max(1, min(max_workers, len(uncached)))
+        shares = [uncached[i::workers] for i in range(workers)]
+
+        def fetch(usernames):
+            return [(username, self._fetch_profile_by_username(username))
+                    for username in usernames]
+
+        found = {}
+        for results in self._lookup_pool().map(fetch, shares):
+            found.update(results)
+        profiles.update((username, found[username]) for username in uncached)
+        return profiles
+
+    @staticmethod
+    def _lookup_pool():
+        cls = OpenstaxAccounts
+        with cls._lookup_pool_lock:
+            if cls.lookup_pool is None:
+                cls.lookup_pool = ThreadPool(cls.lookup_concurrency)
+            return cls.lookup_pool
 
     def update_email(self, existing_emails, email):
-        for email in existing_emails:
-            self.request('/api/contact_infos/{}'.format(email['id']))
+        """Adds the ``email`` address to the user's contact infos, unless
+        it is one of ``existing_emails`` (addresses or contact infos).
+        Returns the new contact info, or ``None`` if there is none.
+        """
+        existing = [info['value'] if isinstance(info, dict) else info
+                    for info in existing_emails]
+        if not email or email in existing:
+            return None
         contact_info = self.request('/api/contact_infos.json',
                                     data=json.dumps({
                                         'type': 'EmailAddress',
                                         'value': email,
                                         }))
+        if not isinstance(contact_info, dict) or 'value' not in contact_info:
+            contact_info = {'type': 'EmailAddress', 'value': email}
+        return contact_info
 
     def update_profile(self, request, **post_data):
-        emails = [i for i in request.user.get('contact_infos', [])
-                  if i['type'] == 'EmailAddress']
-        # separate api for updating email address
-        if post_data.get('email') and post_data['email'] not in emails:
-            self.update_email(emails, post_data['email'])
-
-        self.request('/api/user.json', method='PUT',
-                     data=json.dumps(post_data), parser=lambda a: a)
-
-        # update request.user
-        me = self.get_profile()
-        request.session.update({
-            'profile': me,
-            'username': me.get('username'),
-            })
-        request.session.changed()
+        profile = request.user or {}
+        emails = email_addresses(profile)
+        # Separate api for updating the email address, sent alongside
+        # the profile update when the address has changed.
+        email = post_data.get('email')
+        email_result = {}
+        email_thread = None
+        if email and email not in emails:
+            def update_email():
+                try:
+                    email_result['contact_info'] = self.update_email(
+                        emails, email)
+                except Exception as exc:
+                    email_result['error'] = exc
+
+            email_thread = threading.Thread(
+                target=update_email, name='openstax-accounts-email')
+            email_thread.daemon = True
+            email_thread.start()
+
+        try:
+            updated = self.request('/api/user.json', method='PUT',
+                                   data=json.dumps(post_data),
+                                   parser=parse_update_response)
+        finally:
+            if email_thread is not None:
+                email_thread.join()
+        contact_info = email_result.get('contact_info')
+
+        # update request.user, without fetching the profile again
+        if updated is None:
+            me = merge_profile(profile, post_data)
+        else:
+            me = updated
+        if contact_info is not None and contact_info['value'] not in (
+                email_addresses(me)):
+            me = merge_profile(me, {}, contact_info)
+        self._forget_profiles([profile.get('username'), me.get('username')])
+        remember_profile(request, me)
+        if 'error' in email_result:
+            # The profile was updated, but not the email address.
+            raise email_result['error']
 
 
 # BBB (11-Mar-2015) Deprecated, use 'includeme' by invoking
@@ -196,16 +1106,37 @@ def includeme(config):
     OpenstaxAccounts.singleton(settings)
 
     # Configure a message sending utility.
-    # TODO register is named mapping somewhere rather than hardcode it.
-    msg_sending_util = {
-        'default': send_message,
-        'log': log_message,
-        }[settings.get('message_sender', 'default')]
+    message_sender = settings.get('message_sender', 'default')
+    if message_sender == 'async':
+        registry = config.registry
+        block_timeout = settings.get('message_sender.block_timeout')
+        msg_sending_util = QueuedMessageSender(
+            send=lambda msg_data: send_message(msg_data, registry=registry),
+            workers=int(settings.get('message_sender.workers', 2)),
+            queue_size=int(settings.get('message_sender.queue_size', 1000)),
+            block=settings.get('message_sender.backpressure',
+                               'block') == 'block',
+            block_timeout=block_timeout and float(block_timeout))
+        atexit.register(msg_sending_util.close)
+    else:
+        # TODO register is named mapping somewhere rather than hardcode it.
+        msg_sending_util = {
+            'default': send_message,
+            'log': log_message,
+            }[message_sender]
     config.registry.registerUtility(msg_sending_util, IMessageSender)
 
     openstax_accounts = OpenstaxAccounts()
-    # FIXME Do this as an application startup event.
-    openstax_accounts.request_application_token()
+    # The application token is fetched when first used, or in the
+    # background once the application has been created.
+    application_token = ApplicationToken(
+        openstax_accounts,
+        refresh_margin=int(settings.get('application_token.refresh_margin',
+                                        60)))
+    openstax_accounts.application_token = application_token
+    if asbool(settings.get('application_token.background', True)):
+        config.add_subscriber(lambda event: application_token.start(),
+                              ApplicationCreated)
     config.registry.registerUtility(openstax_accounts, IOpenstaxAccounts)
 
     config.registry.registerUtility(OpenstaxAccounts, IOpenstaxAccounts,
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Server-side storage of the logged in users' profiles.
+
+When an ``IProfileStore`` utility is configured (``profile_store`` is
+``memory`` or ``sqlite``), the session holds the username, the key of
+the profile in the store and the version of the profile it has seen,
+rather than the whole profile. ``request.user`` loads the profile from the store
+when first used (see ``load_profile``).
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from zope.interface import implementer
+
+from .cache import MISSING, TTLCache
+from .interfaces import IProfileStore
+from .utils import local_settings
+
+
+__all__ = (
+    'MemoryProfileStore', 'SQLiteProfileStore',
+    'load_profile', 'remember_profile',
+    )
+
+
+@implementer(IProfileStore)
+class MemoryProfileStore(object):
+    """Keeps the profiles in a process local LRU cache. Profiles not used
+    for ``ttl`` seconds are dropped.
+    """
+
+    def __init__(self, maxsize=10000, ttl=86400):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is MISSING:
+            return None, None
+        return entry
+
+    def set(self, key, profile):
+        with self._lock:
+            version = self.cache.get_stale(key, (0, None))[0] + 1
+            self.cache.set(key, (version, profile))
+        return version
+
+    def delete(self, key):
+        self.cache.invalidate(key)
+
+
+@implementer(IProfileStore)
+class SQLiteProfileStore(object):
+    """Keeps the profiles in a SQLite database, which can be shared by the
+    processes of an application on the same host.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS profiles ('
+                'key TEXT PRIMARY KEY, version INTEGER NOT NULL, '
+                'profile TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        # SQLite connections can not be shared between threads.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            if self.path != ':memory:':
+                connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT version, profile FROM profiles WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def set(self, key, profile):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO profiles VALUES (?, 0, ?, ?)',
+                (key, '', time.time()))
+            connection.execute(
+                'UPDATE profiles SET version = version + 1, profile = ?, '
+                'updated = ? WHERE key = ?',
+                (json.dumps(profile), time.time(), key))
+            return connection.execute(
+                'SELECT version FROM profiles WHERE key = ?',
+                (key,)).fetchone()[0]
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM profiles WHERE key = ?', (key,))
+
+
+def remember_profile(request, profile, username=None):
+    """Saves ``profile`` as the profile of the logged in user, in the
+    profile store if there is one, in the session otherwise.
+    """
+    if username is None:
+        username = profile and profile.get('username')
+    store = request.registry.queryUtility(IProfileStore)
+    if store is None or profile is None:
+        request.session.update({
+            'profile': profile,
+            'username': username,
+            })
+    else:
+        version = store.set(username, profile)
+        request.session.pop('profile', None)
+        request.session.update({
+            'username': username,
+            'profile_key': username,
+            'profile_version': version,
+            })
+    request.session.changed()
+
+
+def load_profile(request):
+    """Loads the profile of the logged in user, ``None`` if the store no
+    longer has (the version the session has seen of) the profile.
+    """
+    session = request.session
+    if 'profile' in session:
+        # The profile is in the session (no profile store).
+        return session['profile']
+    key = session.get('profile_key')
+    store = request.registry.queryUtility(IProfileStore)
+    if key is None or store is None:
+        return None
+    version, profile = store.get(key)
+    if version is None or version < session.get('profile_version', 0):
+        return None
+    return profile
+
+
+def includeme(config):
+    settings = local_settings(config.registry.settings)
+    # The memory store is local to the process, so it is only the
+    # default when asked for.
+    store_type = settings.get('profile_store', 'session')
+    if store_type == 'session':
+        return
+    if store_type == 'memory':
+        store = MemoryProfileStore(
+            maxsize=int(settings.get('profile_store.size', 10000)),
+            ttl=float(settings.get('profile_store.ttl', 86400)))
+    elif store_type == 'sqlite':
+        store = SQLiteProfileStore(settings['profile_store.path'])
+    else:
+        raise ValueError('Unknown profile store "{}"'.format(store_type))
+    config.registry.registerUtility(store, IProfileStore)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Helpers that keep the accounts client responsive when the accounts
+server is slow or unhealthy.
+"""
+import random
+import threading
+import time
+try:
+    import Queue as queue  # python2
+except ImportError:
+    import queue  # renamed in python3
+
+
+__all__ = ('CircuitBreaker', 'CircuitOpenError', 'backoff', 'hedged')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while the circuit is open."""
+
+
+class CircuitBreaker(object):
+    """Stops requests to an unhealthy server.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    ``allow`` returns false for ``reset_timeout`` seconds. Then a single
+    trial request is let through: the circuit closes if it succeeds and
+    stays open for another ``reset_timeout`` if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        opened_at = self.opened_at
+        if opened_at is None:
+            return 'closed'
+        if time.time() < opened_at + self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() < self.opened_at + self.reset_timeout:
+                return False
+            # Let one trial request through, the others keep failing fast
+            # until it succeeds.
+            self.opened_at = time.time()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+def backoff(attempt, base=0.1, cap=2.0):
+    """Seconds to wait before retry number ``attempt`` (from zero),
+    exponential with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def hedged(func, delay):
+    """Calls ``func`` and, when it has not returned after ``delay``
+    seconds, calls it a second time concurrently. Returns the first
+    successful result, or raises the error of the last failed call.
+    """
+    results = queue.Queue()
+
+    def call():
+        try:
+            results.put((True, func()))
+        except Exception as exc:
+            results.put((False, exc))
+
+    def start():
+        thread = threading.Thread(target=call)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    pending = 1
+    try:
+        succeeded, value = results.get(timeout=delay)
+        pending -= 1
+    except queue.Empty:
+        start()
+        pending += 1
+        succeeded, value = results.get()
+        pending -= 1
+    while not succeeded and pending:
+        succeeded, value = results.get()
+        pending -= 1
+    if not succeeded:
+        raise value
+    return value
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 
-import cgi
-import copy
-import fnmatch
+import atexit
+import bisect
+import csv
+import heapq
+import io
+import itertools
 import json
 import logging
+import operator
+import os
+import re
+import threading
+from collections import OrderedDict, deque, namedtuple
+try:
+    from collections.abc import Mapping  # python3
+except ImportError:
+    from collections import Mapping  # python2
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.interfaces import IAuthenticationPolicy
@@ -15,10 +27,50 @@ from pyramid.threadlocal import get_current_registry
 from pyramid.view import view_config
 from zope.interface import implementer, Interface
 
-from .authentication_policy import get_user_from_session
+from .cache import MISSING, TTLCache
+from .groups import get_group_index
 from .interfaces import *
-from .openstax_accounts import UserNotFoundException
-from .utils import local_settings
+from .openstax_accounts import (
+    UserNotFoundException, build_message_data, lookup_userid,
+    normalize_order_by, resolve_userids)
+from .profile_store import load_profile, remember_profile
+from .utils import (
+    chunked, clear_request_memo, local_settings, memoized_on_request)
+
+try:
+    string_types = basestring  # python2
+except NameError:
+    string_types = str  # python3
+
+if str is bytes:  # python2, the csv module reads bytes
+    def _open_csv(path):
+        return io.open(path, 'rb')
+
+    def _decode_cell(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+else:  # python3
+    def _open_csv(path):
+        return io.open(path, newline='', encoding='utf-8')
+
+    def _decode_cell(value):
+        return value
+
+
+def get_user(request):
+    """The profile of the logged in user (``request.user``)."""
+    profile = load_profile(request)
+    if profile is None and request.session.get('profile_key'):
+        # The profile store has lost the profile, e.g. it is local to
+        # another process.
+        policy = request.registry.getUtility(
+            IOpenstaxAccountsAuthenticationPolicy)
+        user = policy.users.get(request.session.get('username'))
+        if user is not None:
+            profile = user['profile']
+            remember_profile(request, profile)
+    return profile
 
 
 DEFAULT_PROFILE = {
@@ -31,22 +83,196 @@ DEFAULT_PROFILE = {
     }
 
 
-def get_users_from_settings(setting):
-    users = {}
-    for i, user in enumerate(aslist(setting, flatten=False)):
+class StubUsers(Mapping):
+    """The stub users by username, each a dict with a ``password`` and a
+    ``profile``, also indexed by user id. ``users`` is a mapping or an
+    iterable of ``(username, user)`` pairs.
+    """
+
+    def __init__(self, users=()):
+        self._users = {}
+        self._ids = {}
+        self._max_id = 0
+        self._search_index = None
+        if isinstance(users, Mapping):
+            users = users.items()
+        for username, user in users:
+            self.add(username, user['password'], user['profile'])
+
+    def __getitem__(self, username):
+        return self._users[username]
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def __len__(self):
+        return len(self._users)
+
+    def add(self, username, password, profile):
+        """Adds (or replaces) the user ``username``. Raises ``ValueError``
+        if another user has the same id.
+        """
+        userid = profile.get('id')
+        if userid is not None:
+            other = self._ids.get(userid, username)
+            if other != username:
+                raise ValueError('Users "{}" and "{}" have the same id {}'
+                                 .format(other, username, userid))
+        previous = self._users.get(username)
+        if previous is not None:
+            self._ids.pop(previous['profile'].get('id'), None)
+        self._users[username] = {
+            'profile': profile,
+            'password': password,
+            }
+        if userid is not None:
+            self._ids[userid] = username
+            if isinstance(userid, int):
+                self._max_id = max(self._max_id, userid)
+        self._search_index = None
+
+    def next_id(self):
+        """An id no user has, greater than all the user ids."""
+        return self._max_id + 1
+
+    def profile(self, username):
+        """The profile of ``username``, ``None`` if there is no such user."""
+        user = self._users.get(username)
+        return user and user['profile']
+
+    def profile_by_id(self, userid):
+        """The profile of the user with id ``userid``, ``None`` if there
+        is no such user.
+        """
+        try:
+            username = self._ids.get(int(userid))
+        except (TypeError, ValueError):
+            return None
+        return self.profile(username)
+
+    def profiles(self, usernames):
+        """The profiles of ``usernames``, by username."""
+        return dict((username, self.profile(username))
+                    for username in usernames)
+
+    def profiles_by_ids(self, userids):
+        """The profiles of the users with ``userids``, by user id."""
+        return dict((userid, self.profile_by_id(userid))
+                    for userid in userids)
+
+    @property
+    def search_index(self):
+        """The ``UserSearchIndex`` of the users, built when first used."""
+        if self._search_index is None:
+            self._search_index = UserSearchIndex(self)
+        return self._search_index
+
+
+def default_profile(**fields):
+    """A profile with the ``DEFAULT_PROFILE`` fields not in ``fields``.
+
+    The default values are immutable, so they are shared by the profiles
+    rather than copied for every user.
+    """
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(fields)
+    return profile
+
+
+def get_users_from_settings(setting, users=None):
+    """Adds the users of the ``stub.users`` setting to ``users``, a
+    ``StubUsers``, numbered after its greatest user id.
+    """
+    if users is None:
+        users = StubUsers()
+    for user in aslist(setting or '', flatten=False):
         if user.count(',') > 1:
             username, password, profile = user.split(',', 2)
             profile = json.loads(profile)
         else:
             username, password = user.split(',', 1)
-            profile = copy.deepcopy(DEFAULT_PROFILE)
+            profile = default_profile()
 
-        profile['id'] = i + 1
+        profile['id'] = users.next_id()
         profile['username'] = username
-        users[username] = {
-            'profile': profile,
-            'password': password,
-            }
+        users.add(username, password, profile)
+    return users
+
+
+def _read_csv_users(f):
+    for row in csv.DictReader(f):
+        row = dict((_decode_cell(name), _decode_cell(value))
+                   for name, value in row.items())
+        username = row.pop('username')
+        password = row.pop('password')
+        # Empty columns fall back to the default fields.
+        yield username, password, dict((name, value)
+                                       for name, value in row.items()
+                                       if value)
+
+
+def _read_json_users(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            user = json.loads(line)
+            yield (user['username'], user['password'],
+                   user.get('profile') or {})
+
+
+def read_users_file(path, users=None):
+    """Adds the users of the CSV (``.csv``) or JSON Lines file at
+    ``path`` to ``users``, a ``StubUsers``. The file is streamed, one user
+    at a time.
+
+    A CSV file has a ``username`` and a ``password`` column, the other
+    columns are profile fields. A JSON Lines file has an object per line,
+    with a ``username``, a ``password`` and an optional ``profile``.
+    Missing profile fields take their default value, users without an
+    ``id`` are numbered after the greatest user id. Raises ``ValueError``
+    if two users have the same id.
+    """
+    if users is None:
+        users = StubUsers()
+    if path.lower().endswith('.csv'):
+        f, read = _open_csv(path), _read_csv_users
+    else:
+        f, read = io.open(path, encoding='utf-8'), _read_json_users
+    with f:
+        for username, password, fields in read(f):
+            profile = default_profile(**fields)
+            profile['id'] = int(fields.get('id') or users.next_id())
+            profile['username'] = username
+            users.add(username, password, profile)
+    return users
+
+
+def add_synthetic_users(count, users=None, password='password'):
+    """Adds ``count`` generated users (``user<id>``) with the default
+    profile to ``users``, a ``StubUsers``, e.g. for load testing.
+    """
+    if users is None:
+        users = StubUsers()
+    userid = users.next_id()
+    for i in range(count):
+        while 'user{}'.format(userid) in users:
+            userid += 1
+        username = 'user{}'.format(userid)
+        users.add(username, password,
+                  default_profile(id=userid, username=username))
+        userid += 1
+    return users
+
+
+def load_users(settings):
+    """The stub users from the (local) ``stub.users``,
+    ``stub.users_file`` and ``stub.synthetic_users`` settings.
+    """
+    users = get_users_from_settings(settings.get('stub.users'))
+    if settings.get('stub.users_file'):
+        read_users_file(settings['stub.users_file'], users)
+    if settings.get('stub.synthetic_users'):
+        add_synthetic_users(int(settings['stub.synthetic_users']), users)
     return users
 
 
@@ -56,25 +282,17 @@ class StubAuthenticationPolicy(object):
         self.users = users
 
     def _groups(self, request):
-        """A mapping of group ids a list of user ids"""
-        # TODO Ideally, we'd use the accounts groups, but the implementation
-        #      of groups in accounts is not fleshed out enough at this time.
-        #      So for now we pull them from configuration settings.
-        if not hasattr(self, '_parsed_groups'):
-            self._parsed_groups = {}
-            settings = request.registry.settings
-            prefix = 'openstax_accounts.groups'
-            groups = local_settings(settings, prefix=prefix)
-            for group_name, values in groups.items():
-                self._parsed_groups[group_name] = aslist(values)
-        return self._parsed_groups
+        """A mapping of group ids to (frozen) sets of user ids"""
+        # The groups come from the configuration settings, a groups file
+        # or accounts (``openstax_accounts.groups_from_accounts``),
+        # see ``groups.includeme``.
+        return get_group_index(request).groups
 
     def _membership(self, request, userid):
         """List of groups this `userid` has membership with."""
-        return [group_name
-                for group_name, userids in self._groups(request).items()
-                if userid in userids]
+        return get_group_index(request).membership(userid)
 
+    @memoized_on_request
     def authenticated_userid(self, request):
         settings = request.registry.settings
         login_path = settings['openstax_accounts.login_path']
@@ -95,25 +313,23 @@ class StubAuthenticationPolicy(object):
     def unauthenticated_userid(self, request):
         return request.session.get('username')
 
+    @memoized_on_request
     def effective_principals(self, request):
         principals = [Everyone]
         userid = self.authenticated_userid(request)
         if userid:
             principals.append(Authenticated)
             principals.append(userid)
-        principals.extend(['g:{}'.format(name)
-                           for name in self._membership(request, userid)])
+        principals.extend(get_group_index(request).principals(userid))
         return principals
 
     def remember(self, request, principal, **kw):
-        request.session.update({
-            'username': principal,
-            'profile': kw.get('profile'),
-            })
-        request.session.changed()
+        clear_request_memo(request)
+        remember_profile(request, kw.get('profile'), username=principal)
         return []
 
     def forget(self, request):
+        clear_request_memo(request)
         request.session.clear()
         return []
 
@@ -165,86 +381,505 @@ class LogWriter(object):
 
 @implementer(IStubMessageWriter)
 class FileWriter(object):
+    """Appends the messages to the file at ``path``, which is kept open.
+
+    Messages are buffered and written when the buffer holds
+    ``buffer_size`` bytes, every ``flush_interval`` seconds (by a
+    background thread) and on ``close``. Once the file would grow beyond
+    ``max_bytes`` (if given), it is renamed to ``<path>.1``, the older
+    files to ``<path>.2`` and so on, keeping ``backup_count`` of them.
+    """
+
+    def __init__(self, path='messages.txt', buffer_size=65536,
+                 flush_interval=1, max_bytes=0, backup_count=5):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._buffer = []
+        self._buffered = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
 
     def write(self, s):
-        with open('messages.txt', 'a') as file:
-            file.write("{}\n\n\n".format(s))
+        data = '{}\n\n\n'.format(s).encode('utf-8')
+        with self._lock:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if self._buffered >= self.buffer_size:
+                self._flush()
+            elif self._thread is None:
+                self._start()
+
+    def flush(self):
+        """Writes the buffered messages to the file."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Writes the buffered messages, closes the file and stops the
+        background thread. The writer can still be used afterwards.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopped.set()
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start(self):
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._stopped,),
+            name='openstax-accounts-stub-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, stopped):
+        while not stopped.wait(self.flush_interval):
+            self.flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        if (self.max_bytes and self._file.tell() and
+                self._file.tell() + len(data) > self.max_bytes):
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}'.format(self.path, i + 1))
+        if self.backup_count:
+            os.rename(self.path, '{}.1'.format(self.path))
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
+
+
+class StubMessage(namedtuple('StubMessage', (
+        'user_ids', 'subject', 'text_body', 'html_body'))):
+    """A message kept by the ``MemoryWriter``."""
+    __slots__ = ()
+
+    @property
+    def data(self):
+        """The ``/api/messages.json`` payload of the message."""
+        return build_message_data(list(self.user_ids), self.subject,
+                                  self.text_body, self.html_body)
 
 
 @implementer(IStubMessageWriter)
 class MemoryWriter(object):
-
-    def __init__(self):
-        self.messages = []
+    """Keeps the last ``capacity`` messages (as ``StubMessage``), indexed
+    by recipient user id and by subject. Older messages are dropped to
+    make room, which is counted in ``dropped``. A ``capacity`` of ``0``
+    (or ``None``) keeps all the messages.
+    """
+
+    def __init__(self, capacity=10000):
+        if capacity is not None and capacity < 0:
+            raise ValueError('The capacity can not be negative')
+        self.capacity = capacity or None
+        self.written = 0
+        self.dropped = 0
+        self._messages = deque()
+        self._by_recipient = {}
+        self._by_subject = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def messages(self):
+        """BBB The kept messages as JSON strings, oldest first. Assigning
+        a list of JSON strings replaces the kept messages, e.g.
+        ``writer.messages = []`` is the same as ``writer.clear()``.
+        """
+        with self._lock:
+            messages = list(self._messages)
+        return [json.dumps(message.data) for message in messages]
+
+    @messages.setter
+    def messages(self, messages):
+        self.clear()
+        for s in messages:
+            self.write(s)
 
     def write(self, s):
-        self.messages.append(s)
+        data = json.loads(s)
+        user_ids = tuple(data.get('to[user_ids][]') or [data['user_id']])
+        with self._lock:
+            subject = data.get('subject')
+            same_subject = self._by_subject.get(subject)
+            if same_subject:
+                # Share the subject string with the earlier messages.
+                subject = same_subject[0].subject
+            message = StubMessage(user_ids, subject, data.get('body[text]'),
+                                  data.get('body[html]'))
+            if self.capacity is not None \
+                    and len(self._messages) >= self.capacity:
+                self._drop()
+            self._messages.append(message)
+            for userid in set(user_ids):
+                self._by_recipient.setdefault(userid, deque()).append(message)
+            self._by_subject.setdefault(subject, deque()).append(message)
+            self.written += 1
+
+    def _drop(self):
+        # The oldest message is also the first one of each of its indexes.
+        message = self._messages.popleft()
+        for index, key in itertools.chain(
+                ((self._by_recipient, userid)
+                 for userid in set(message.user_ids)),
+                [(self._by_subject, message.subject)]):
+            messages = index[key]
+            messages.popleft()
+            if not messages:
+                del index[key]
+        self.dropped += 1
+
+    def by_recipient(self, userid):
+        """The kept messages sent to ``userid``, oldest first."""
+        with self._lock:
+            return list(self._by_recipient.get(int(userid), ()))
+
+    def by_subject(self, subject):
+        """The kept messages with ``subject``, oldest first."""
+        with self._lock:
+            return list(self._by_subject.get(subject, ()))
+
+    def clear(self):
+        """Drops the kept messages, without counting them as dropped."""
+        with self._lock:
+            self._messages.clear()
+            self._by_recipient.clear()
+            self._by_subject.clear()
+
+
+# Profile fields searched for each search keyword, terms without a
+# keyword search all of them.
+SEARCH_FIELDS = {
+    'username': ('username',),
+    'first_name': ('first_name',),
+    'last_name': ('last_name',),
+    'full_name': ('full_name',),
+    'name': ('first_name', 'last_name', 'full_name'),
+    None: ('username', 'first_name', 'last_name', 'full_name'),
+    }
+_QUERY_TERM = re.compile(r'(?:(\w+):)?("[^"]*"|\S+)')
+
+
+def parse_query(query):
+    """Parses an accounts search ``query`` into ``(keyword, values)``
+    terms, e.g. ``username:aaron,babara %son`` into
+    ``[('username', ['aaron', 'babara']), (None, ['%son'])]``.
+    """
+    terms = []
+    for keyword, value in _QUERY_TERM.findall(query):
+        keyword = keyword.lower() or None
+        if keyword not in SEARCH_FIELDS and keyword not in ('id', 'email'):
+            value = '{}:{}'.format(keyword, value)
+            keyword = None
+        values = [v for v in value.strip('"').split(',') if v]
+        if values:
+            terms.append((keyword, values))
+    return terms
+
+
+class _FieldIndex(object):
+    """The (lowercased) values of a profile field in sorted order, for
+    prefix and wildcard searches.
+    """
+
+    def __init__(self, values):
+        entries = sorted((value.lower(), key) for key, value in values
+                         if isinstance(value, string_types))
+        self.values = [value for value, key in entries]
+        self.keys = [key for value, key in entries]
+
+    def match(self, pattern):
+        """The keys of the values starting with ``pattern``, in which
+        ``%`` matches any characters (like accounts' search).
+        """
+        pattern = pattern.lower()
+        prefix = pattern.split('%', 1)[0]
+        start = bisect.bisect_left(self.values, prefix)
+        end = len(self.values)
+        if prefix:
+            end = bisect.bisect_left(self.values, prefix + u'\uffff', start)
+        if '%' not in pattern.rstrip('%'):
+            # A prefix (values match any trailing characters anyway).
+            return self.keys[start:end]
+        regex = re.compile('.*'.join(
+            re.escape(part) for part in pattern.split('%')))
+        return [self.keys[i] for i in range(start, end)
+                if regex.match(self.values[i])]
+
+
+def parse_order_by(order_by):
+    """The ``(field, descending)`` clauses of an ``order_by`` value like
+    ``first_name,last_name DESC``, ending with ``username`` so that ties
+    are ordered by username and pages are stable.
+    """
+    clauses = [clause.split(' ')
+               for clause in normalize_order_by(order_by).split(',')
+               if clause]
+    clauses = [(field, direction == 'DESC') for field, direction in clauses]
+    if 'username' not in [field for field, descending in clauses]:
+        clauses.append(('username', False))
+    return clauses
+
+
+class UserSearchIndex(object):
+    """Indexes the profiles of ``users`` (the stub users by username) to
+    answer accounts searches without scanning all of them.
+    """
+
+    def __init__(self, users):
+        self.profiles = dict((username, user['profile'])
+                             for username, user in users.items())
+        self.usernames = sorted(self.profiles)
+        self.fields = {}
+        for fields in SEARCH_FIELDS.values():
+            for field in fields:
+                if field not in self.fields:
+                    self.fields[field] = _FieldIndex(
+                        (username, profile.get(field))
+                        for username, profile in self.profiles.items())
+        # Ranks of the values of the fields used to sort, see ``_ranks``.
+        self._field_ranks = {
+            'username': dict((username, rank) for rank, username
+                             in enumerate(self.usernames)),
+            }
+        # The usernames in the order of the most recent ``order_by``
+        # values, see ``ordered``.
+        self._orders = {'username ASC': self.usernames}
+        self.ids = {}
+        self.emails = {}
+        for username, profile in self.profiles.items():
+            self.ids.setdefault(str(profile.get('id')), []).append(username)
+            for info in profile.get('contact_infos') or []:
+                if info.get('type') == 'EmailAddress':
+                    self.emails.setdefault(
+                        info['value'].lower(), []).append(username)
+
+    def _ranks(self, field):
+        """The rank of the ``field`` value of every user, by username:
+        users with equal values have the same rank, users without a value
+        rank last. Computed once per field.
+        """
+        ranks = self._field_ranks.get(field)
+        if ranks is None:
+            values = sorted(
+                ((profile.get(field), username)
+                 for username, profile in self.profiles.items()
+                 if profile.get(field) is not None),
+                key=operator.itemgetter(0))
+            ranks = {}
+            rank = -1
+            previous = MISSING
+            for value, username in values:
+                if value != previous:
+                    rank += 1
+                    previous = value
+                ranks[username] = rank
+            missing = rank + 1
+            for username in self.profiles:
+                ranks.setdefault(username, missing)
+            self._field_ranks[field] = ranks
+        return ranks
+
+    def sort_key(self, order_by):
+        """A sort key function for usernames from an ``order_by`` value.
+
+        Missing values sort last, or first when descending (like in
+        PostgreSQL). The key is a single integer combining the ranks of
+        the values (see ``_ranks``), which is much cheaper to sort on than
+        tuples of values.
+        """
+        size = len(self.profiles) + 1
+        columns = [(self._ranks(field), descending)
+                   for field, descending in parse_order_by(order_by)]
+        if len(columns) == 1:
+            ranks, descending = columns[0]
+            if descending:
+                return lambda username: size - 1 - ranks[username]
+            return ranks.__getitem__
+
+        def key(username):
+            value = 0
+            for ranks, descending in columns:
+                rank = ranks[username]
+                value = value * size + (size - 1 - rank if descending else rank)
+            return value
+        return key
+
+    def ordered(self, order_by):
+        """All the usernames, ordered by ``order_by``. Kept for the last
+        few ``order_by`` values.
+        """
+        order_by = normalize_order_by(order_by)
+        usernames = self._orders.get(order_by)
+        if usernames is None:
+            if len(self._orders) >= 16:
+                self._orders = {'username ASC': self.usernames}
+            usernames = sorted(self.profiles, key=self.sort_key(order_by))
+            self._orders[order_by] = usernames
+        return usernames
+
+    def _match(self, keyword, value):
+        if keyword == 'id':
+            return self.ids.get(value, [])
+        if keyword == 'email':
+            return self.emails.get(value.lower(), [])
+        fields = SEARCH_FIELDS[keyword]
+        if 'username' in fields:
+            if not value.strip('%'):
+                # Everyone has a username.
+                return self.usernames
+            # Accounts ignores a leading "@" in usernames.
+            value = value.lstrip('@') or value
+        matches = []
+        for field in fields:
+            matches.extend(self.fields[field].match(value))
+        return matches
+
+    def find(self, query):
+        """The usernames of the users matching all the terms of
+        ``query``, unordered.
+        """
+        found = None
+        for keyword, values in parse_query(query):
+            matches = set()
+            for value in values:
+                matches.update(self._match(keyword, value))
+            found = matches if found is None else found & matches
+            if not found:
+                break
+        return found or set()
+
+    def search(self, query, order_by='username ASC', page=None,
+               per_page=None):
+        """Profiles matching ``query`` ordered by ``order_by``, like the
+        accounts search results.
+        """
+        found = self.find(query)
+        start, end = 0, None
+        if per_page is not None:
+            end = max(int(page or 1), 1) * int(per_page)
+            start = end - int(per_page)
+        if len(found) > len(self.usernames) // 8:
+            # Cheaper than sorting when most of the users match.
+            usernames = self.ordered(order_by)
+            if len(found) < len(usernames):
+                usernames = (username for username in usernames
+                             if username in found)
+            items = [self.profiles[username]
+                     for username in itertools.islice(usernames, end)]
+        elif end is not None:
+            # Only the profiles up to the requested page are sorted.
+            items = [self.profiles[username] for username in heapq.nsmallest(
+                end, found, key=self.sort_key(order_by))]
+        else:
+            items = [self.profiles[username] for username in sorted(
+                found, key=self.sort_key(order_by))]
+        items = items[start:end]
+        return {
+            'items': items,
+            'total_count': len(found),
+            }
 
 
 @implementer(IOpenstaxAccounts)
 class OpenstaxAccounts(object):
-    def __init__(self, users):
+    def __init__(self, users, userid_cache=None, lookup_batch_size=50,
+                 message_batch_size=100):
+        if not isinstance(users, StubUsers):
+            users = StubUsers(users)
         self.users = users
+        if userid_cache is None:
+            userid_cache = TTLCache()
+        self.userid_cache = userid_cache
+        # The same batches as the accounts client, see ``send_messages``.
+        self.lookup_batch_size = lookup_batch_size
+        self.message_batch_size = message_batch_size
 
     def search(self, query, **kwargs):
-        query = query.replace('%', '*')
-        order_by = kwargs.get('order_by', 'username ASC')
-        results = {
-                'items': [],
-                'total_count': 0,
-                }
-        for username in self.users:
-            profile = self.users[username]['profile']
-            for value in profile.values():
-                if fnmatch.fnmatch(username, query) \
-                   or username in query:
-                    results['items'].append(profile)
-                    break
-
-        # sort results
-        for sort_by in order_by.split(','):
-            results['items'].sort(
-                lambda a, b: cmp(a.get(sort_by), b.get(sort_by)))
-        results['total_count'] = len(results['items'])
-
-        return results
+        return self.users.search_index.search(
+            query, order_by=kwargs.get('order_by') or 'username ASC',
+            page=kwargs.get('page'), per_page=kwargs.get('per_page'))
 
     global_search = search
 
+    def iter_search(self, query, page_size=100, prefetch=1, **kwargs):
+        # Paged like the accounts client, not one list of all the results.
+        page = 1
+        seen = 0
+        while True:
+            results = self.search(query, **dict(
+                kwargs, page=page, per_page=page_size))
+            for item in results['items']:
+                yield item
+            seen += len(results['items'])
+            if not results['items'] or seen >= results['total_count']:
+                break
+            page += 1
+
     def send_message(self, username, subject, text_body, html_body=None):
-        users = self.global_search('username:{}'.format(username))
-        userid = None
-        for user in users['items']:
-            if user['username'] == username:
-                userid = user['id']
-        if userid is None:
-            raise UserNotFoundException('User "{}" not found'.format(username))
-
-        if html_body is None:
-            html_body = '<html><body>{}</body></html>'.format(
-                cgi.escape(text_body).replace('\n', '\n<br/>'))
-
-        msg_data = {
-            'user_id': int(userid),
-            'to[user_ids][]': [int(userid)],
-            'subject': subject,
-            'body[text]': text_body,
-            'body[html]': html_body,
-            }
+        userid = self.userid_cache.get(username)
+        if userid is MISSING:
+            userid = lookup_userid(self, username)
+            self.userid_cache.set(username, userid)
+
+        msg_data = build_message_data(userid, subject, text_body, html_body)
 
         write_util = get_current_registry().getUtility(IStubMessageWriter)
         write_util.write(json.dumps(msg_data))
 
+    def send_messages(self, usernames, subject, text_body, html_body=None):
+        usernames = list(OrderedDict.fromkeys(usernames))
+        userids = resolve_userids(self, usernames, self.lookup_batch_size)
+        results = {}
+        write_util = get_current_registry().getUtility(IStubMessageWriter)
+        found = [username for username in usernames if username in userids]
+        for batch in chunked(found, self.message_batch_size):
+            msg_data = build_message_data(
+                [userids[username] for username in batch],
+                subject, text_body, html_body)
+            write_util.write(json.dumps(msg_data))
+            results.update((username, True) for username in batch)
+        for username in usernames:
+            if username not in userids:
+                results[username] = UserNotFoundException(
+                    'User "{}" not found'.format(username))
+        return results
+
     def get_profile(self):
         raise NotImplementedError
 
     def get_profile_by_username(self, username):
-        profile = None
-        for uname, info in self.users.items():
-            if username == uname:
-                profile = info['profile']
-                break
-        return profile
+        return self.users.profile(username)
+
+    def get_profiles_by_usernames(self, usernames, max_workers=10):
+        return self.users.profiles(usernames)
 
     def update_email(self, existing_emails, email):
         raise NotImplementedError
@@ -260,10 +895,10 @@ def main(config):
 
 
 def includeme(config):
-    config.add_request_method(get_user_from_session, 'user', reify=True)
+    config.add_request_method(get_user, 'user', reify=True)
     settings = config.registry.settings
     settings = local_settings(settings)
-    users = get_users_from_settings(settings.get('stub.users'))
+    users = load_users(settings)
     writer_type = settings.get('stub.message_writer', 'file')
 
     # Set authentication policy
@@ -280,9 +915,30 @@ def includeme(config):
         'log': LogWriter,
         'memory': MemoryWriter,
         }
-    writer = writer_mapping[writer_type]()
+    if writer_type == 'file':
+        writer = FileWriter(
+            path=settings.get('stub.message_writer.path', 'messages.txt'),
+            buffer_size=int(settings.get(
+                'stub.message_writer.buffer_size', 65536)),
+            flush_interval=float(settings.get(
+                'stub.message_writer.flush_interval', 1)),
+            max_bytes=int(settings.get('stub.message_writer.max_bytes', 0)),
+            backup_count=int(settings.get(
+                'stub.message_writer.backup_count', 5)))
+        atexit.register(writer.close)
+    elif writer_type == 'memory':
+        writer = MemoryWriter(capacity=int(settings.get(
+            'stub.message_writer.capacity', 10000)))
+    else:
+        writer = writer_mapping[writer_type]()
     config.registry.registerUtility(writer, IStubMessageWriter)
-    openstax_accounts = OpenstaxAccounts(users)
+    userid_cache = TTLCache(
+        maxsize=int(settings.get('userid_cache.size', 4096)),
+        ttl=float(settings.get('userid_cache.ttl', 3600)))
+    openstax_accounts = OpenstaxAccounts(
+        users, userid_cache=userid_cache,
+        lookup_batch_size=int(settings.get('lookup_batch_size', 50)),
+        message_batch_size=int(settings.get('message_batch_size', 100)))
     config.registry.registerUtility(openstax_accounts, IOpenstaxAccounts)
 
     config.scan(package='openstax_accounts.stub')
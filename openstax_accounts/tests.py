@@ -3,13 +3,22 @@ try:
 except ImportError:
     import configparser as ConfigParser  # renamed in python3
 import functools
+import hashlib
 import json
 import os
 import random
 import subprocess
+import sys
 import time
 import re
+import threading
 import unittest
+try:
+    import BaseHTTPServer  # python2
+    import SocketServer as socketserver  # python2
+except ImportError:
+    import http.server as BaseHTTPServer  # renamed in python3
+    import socketserver  # renamed in python3
 try:
     import urlparse  # python2
 except ImportError:
@@ -58,6 +67,110 @@ def read_config(testing_ini):
     return testing_ini, config, app_url
 
 
+def email_values(profile):
+    return [info['value'] for info in profile['contact_infos']]
+
+
+class FakeAccountsServer(socketserver.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """A local stand-in for openstax/accounts.
+    ``routes`` maps ``(method, path)`` to a callable taking the handler and
+    returning ``(status, headers, body)``.
+    Conditional GET requests are answered with 304 when the route's
+    ``ETag`` or ``Last-Modified`` headers match; with ``etags`` set, an
+    ``ETag`` is added to every successful GET response.
+    ``peak_in_flight`` is the largest number of requests handled at once.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    etags = False
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.statuses = []
+        self.connections = 0
+        self.in_flight = self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), FakeAccountsHandler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_port)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def route(self, method, path, body, status=200, headers=None):
+        if not callable(body):
+            value = body
+            body = lambda handler: (status, headers or {}, value)
+        self.routes[(method, path)] = body
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeAccountsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer the response, so headers and body go out in one packet.
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self):
+        parts = urlparse.urlsplit(self.path)
+        length = int(self.headers.get('content-length') or 0)
+        self.body = self.rfile.read(length)
+        self.query = dict(urlparse.parse_qsl(parts.query))
+        self.server.requests.append((self.command, parts.path, self.query))
+        route = self.server.routes.get((self.command, parts.path))
+        if route is None:
+            status, headers, body = 404, {}, {'error': 'not found'}
+        else:
+            with self.server.lock:
+                self.server.in_flight += 1
+                self.server.peak_in_flight = max(self.server.peak_in_flight,
+                                                 self.server.in_flight)
+            try:
+                status, headers, body = route(self)
+            finally:
+                with self.server.lock:
+                    self.server.in_flight -= 1
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        headers = dict(headers)
+        if self.command == 'GET' and status == 200:
+            if self.server.etags:
+                headers.setdefault('ETag', '"{}"'.format(
+                    hashlib.md5(body).hexdigest()))
+            if self._not_modified(headers):
+                status, body = 304, b''
+        self.server.statuses.append(status)
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'application/json; charset=utf-8')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self, headers):
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match is not None:
+            return if_none_match == headers.get('ETag')
+        if_modified_since = self.headers.get('if-modified-since')
+        return (if_modified_since is not None
+                and if_modified_since == headers.get('Last-Modified'))
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+
 class UtilsTests(unittest.TestCase):
 
     def test_local_settings(self):
@@ -75,6 +188,1905 @@ class UtilsTests(unittest.TestCase):
         from .utils import local_settings
         self.assertEqual(expected, local_settings(settings, prefix='xyz'))
 
+    def test_chunked(self):
+        from .utils import chunked
+        self.assertEqual(chunked([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(chunked([], 2), [])
+
+    def test_prefetched(self):
+        from .utils import prefetched
+        produced = []
+
+        def numbers():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        for size in (0, 1, 3):
+            del produced[:]
+            self.assertEqual(list(prefetched(numbers(), size)),
+                             list(range(10)))
+
+        del produced[:]
+        iterator = prefetched(numbers(), 2)
+        self.assertEqual(next(iterator), 0)
+        time.sleep(0.05)
+        # One item consumed, two waiting and one being put on the queue.
+        self.assertEqual(produced, [0, 1, 2, 3])
+        iterator.close()
+
+    def test_prefetched_error(self):
+        from .utils import prefetched
+
+        def failing():
+            yield 1
+            raise ValueError('failed')
+
+        iterator = prefetched(failing(), 1)
+        self.assertEqual(next(iterator), 1)
+        with self.assertRaises(ValueError):
+            next(iterator)
+
+
+class TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAccountsServer()
+        self.addCleanup(self.server.stop)
+        self.server.route('GET', '/api/user.json', {'username': 'aaron'})
+
+    def make_one(self, **kwargs):
+        from .transport import Transport
+        transport = Transport(**kwargs)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_reuses_connection(self):
+        transport = self.make_one()
+        url = urlparse.urljoin(self.server.url, '/api/user.json')
+        for i in range(5):
+            response = transport.request('GET', url)
+            self.assertEqual(json.loads(response.text),
+                             {'username': 'aaron'})
+        self.assertEqual(self.server.connections, 1)
+
+    def test_http_error(self):
+        from .transport import HTTPError
+        transport = self.make_one()
+        url = urlparse.urljoin(self.server.url, '/api/missing.json')
+        with self.assertRaises(HTTPError) as caught_exc:
+            transport.request('GET', url)
+        self.assertEqual(caught_exc.exception.code, 404)
+        # The connection is still usable after an error response.
+        transport.request('GET',
+                          urlparse.urljoin(self.server.url, '/api/user.json'))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pool_size(self):
+        transport = self.make_one(pool_size=2)
+        url = urlparse.urljoin(self.server.url, '/api/user.json')
+        results = []
+
+        def fetch():
+            for i in range(5):
+                results.append(transport.request('GET', url).status)
+
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [200] * 20)
+        self.assertEqual(transport._pools.popitem()[1].qsize(), 2)
+
+    def test_stale_connection(self):
+        transport = self.make_one()
+        url = urlparse.urljoin(self.server.url, '/api/user.json')
+        transport.request('GET', url)
+        # Simulate the server closing the kept-alive connection.
+        conn = list(transport._pools.values())[0].queue[0]
+        conn.sock.close()
+        response = transport.request('GET', url)
+        self.assertEqual(response.status, 200)
+
+    def test_post_not_replayed(self):
+        import socket
+        from .transport import _STALE_CONNECTION_ERRORS
+        posted = []
+
+        def reset(handler):
+            posted.append(handler.body)
+            # Drop the connection once the request has been received.
+            raise socket.error('connection reset')
+
+        self.server.route('POST', '/api/messages.json', reset)
+        self.server.handle_error = lambda request, client_address: None
+        transport = self.make_one()
+        transport.request(
+            'GET', urlparse.urljoin(self.server.url, '/api/user.json'))
+        with self.assertRaises(_STALE_CONNECTION_ERRORS):
+            transport.request(
+                'POST', urlparse.urljoin(self.server.url,
+                                         '/api/messages.json'),
+                body='subject=Hi')
+        self.assertEqual(posted, [b'subject=Hi'])
+
+
+class TTLCacheTests(unittest.TestCase):
+
+    def make_one(self, **kwargs):
+        from .cache import TTLCache
+        return TTLCache(**kwargs)
+
+    def test_lru_eviction(self):
+        from .cache import MISSING
+        cache = self.make_one(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used entry.
+        self.assertEqual(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {
+            'size': 2, 'maxsize': 2, 'bytes': 0, 'maxbytes': None,
+            'hits': 3, 'misses': 1, 'evictions': 1,
+            })
+
+    def test_maxbytes(self):
+        from .cache import MISSING
+        cache = self.make_one(maxbytes=10, sizeof=len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.get('a'), MISSING)
+        self.assertEqual(cache.bytes, 8)
+        cache.set('b', 'b' * 11)
+        # Too large to cache, also drops the previous value.
+        self.assertEqual(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.bytes, 4)
+        cache.invalidate_if(lambda key: key == 'c')
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_expiry(self):
+        from .cache import MISSING
+        cache = self.make_one(ttl=60)
+        cache.set('a', None)
+        cache.set('b', 2, ttl=-1)
+        cache.set('c', 3, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('c'), MISSING)
+        # Expired entries can still be had when nothing better is available.
+        self.assertEqual(cache.get_stale('c'), 3)
+        self.assertEqual(cache.get_stale('d'), MISSING)
+
+
+class ResilienceTests(unittest.TestCase):
+
+    def test_circuit_breaker(self):
+        from .resilience import CircuitBreaker
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        time.sleep(0.05)
+        # A single trial request is let through.
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_hedged(self):
+        from .resilience import hedged
+        calls = []
+
+        def slow_then_fast():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.2)
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual(hedged(slow_then_fast, 0.01), 'fast')
+        self.assertEqual(hedged(lambda: 'quick', 0.01), 'quick')
+
+        def failing():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            hedged(failing, 0.01)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        from .metrics import Histogram
+        histogram = Histogram((1, 10, 100))
+        self.assertEqual(histogram.percentile(50), None)
+        for value in (0.5, 5, 5, 50, 500):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.percentile(50), 10)
+        self.assertEqual(histogram.percentile(80), 100)
+        self.assertEqual(histogram.percentile(100), 500)
+
+    def test_metrics(self):
+        from .metrics import Metrics
+        recorded = []
+
+        class Sink(object):
+            def record(self, *args):
+                recorded.append(args)
+
+        metrics = Metrics([Sink()])
+        metrics.record('search', 0.02, 300)
+        metrics.record('search', 2, error='HTTP 500')
+        metrics.record('search', None, error='circuit_open')
+        self.assertEqual(recorded, [('search', 0.02, 300, None),
+                                    ('search', 2, 0, 'HTTP 500'),
+                                    ('search', None, 0, 'circuit_open')])
+        snapshot = metrics.snapshot()['search']
+        # The request that was not sent is only counted as an error.
+        self.assertEqual(snapshot['requests'], 2)
+        self.assertEqual(snapshot['errors'],
+                         {'HTTP 500': 1, 'circuit_open': 1})
+        # Failures do not count in the latency and size of the responses.
+        self.assertEqual(snapshot['latency']['count'], 1)
+        self.assertEqual(snapshot['latency']['p50'], 0.02)
+        self.assertEqual(snapshot['error_latency']['p50'], 2)
+        self.assertEqual(snapshot['size']['count'], 1)
+        self.assertEqual(snapshot['size']['sum'], 300)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_statsd_sink(self):
+        import socket
+        from .metrics import make_metrics
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        metrics = make_metrics({
+            'metrics.sinks': 'statsd',
+            'metrics.statsd_host': '127.0.0.1',
+            'metrics.statsd_port': str(server.getsockname()[1]),
+            'metrics.statsd_prefix': 'app',
+            })
+        metrics.record('profile', 0.0125, 42)
+        self.assertEqual(server.recv(1024).decode('utf-8').split('\n'), [
+            'app.profile.requests:1|c',
+            'app.profile.latency:12.500|ms',
+            'app.profile.size:42|h',
+            ])
+        metrics.record('profile', 0.0125, error='timeout')
+        self.assertEqual(server.recv(1024).decode('utf-8').split('\n'), [
+            'app.profile.requests:1|c',
+            'app.profile.error_latency:12.500|ms',
+            'app.profile.errors:1|c',
+            ])
+        metrics.record('profile', None, error='circuit_open')
+        self.assertEqual(server.recv(1024).decode('utf-8').split('\n'), [
+            'app.profile.errors:1|c',
+            ])
+        with self.assertRaises(ValueError):
+            make_metrics({'metrics.sinks': 'carrier-pigeon'})
+
+
+class GroupIndexTests(unittest.TestCase):
+
+    def test_index(self):
+        from .groups import GroupIndex
+        index = GroupIndex({
+            'grp_sol': ['aaron', 'babara'],
+            'grp_luna': ['babara', 'dale'],
+            })
+        self.assertEqual(index.principals('babara'),
+                         frozenset(['g:grp_sol', 'g:grp_luna']))
+        self.assertEqual(index.principals('aaron'), frozenset(['g:grp_sol']))
+        self.assertEqual(index.principals('earl'), frozenset())
+        self.assertEqual(index.principals(None), frozenset())
+        self.assertEqual(sorted(index.membership('babara')),
+                         ['grp_luna', 'grp_sol'])
+
+    def test_effective_principals(self):
+        from pyramid import testing
+        from pyramid.security import Authenticated, Everyone
+        from .stub import StubAuthenticationPolicy
+        config = testing.setUp(settings={
+            'openstax_accounts.login_path': '/login',
+            'openstax_accounts.callback_path': '/callback',
+            'openstax_accounts.groups.grp_sol': 'aaron\nbabara',
+            'openstax_accounts.groups.grp_luna': 'babara\ndale',
+            })
+        self.addCleanup(testing.tearDown)
+        config.include('openstax_accounts.groups')
+        policy = StubAuthenticationPolicy({})
+        request = testing.DummyRequest(path='/')
+        request.session['username'] = 'babara'
+        self.assertEqual(sorted(policy.effective_principals(request)), sorted([
+            Authenticated, Everyone, 'babara', 'g:grp_luna', 'g:grp_sol']))
+
+
+class FileGroupProviderTests(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'groups.json')
+
+    def write_groups(self, content):
+        # Replace the file atomically, the way editors and deployments do.
+        with open(self.path + '.new', 'w') as f:
+            f.write(content)
+        os.rename(self.path + '.new', self.path)
+
+    def test_reload(self):
+        from .groups import FileGroupProvider
+        self.write_groups(json.dumps({'grp_sol': ['aaron']}))
+        provider = FileGroupProvider(self.path,
+                                     groups={'grp_luna': ['babara']})
+        index = provider.index
+        self.assertEqual(index.principals('aaron'), frozenset(['g:grp_sol']))
+        self.assertEqual(index.principals('babara'),
+                         frozenset(['g:grp_luna']))
+        self.assertFalse(provider.reload())
+
+        self.write_groups(json.dumps({'grp_sol': ['babara']}))
+        self.assertTrue(provider.reload())
+        self.assertEqual(provider.index.principals('babara'),
+                         frozenset(['g:grp_sol', 'g:grp_luna']))
+        # The previous index is left untouched for the requests using it.
+        self.assertEqual(index.principals('aaron'), frozenset(['g:grp_sol']))
+
+        # An invalid file keeps the last good membership.
+        self.write_groups('{"grp_sol": ')
+        self.assertFalse(provider.reload())
+        self.write_groups(json.dumps(['aaron']))
+        self.assertFalse(provider.reload())
+        self.write_groups(json.dumps({'grp_sol': [{'id': 1}]}))
+        self.assertFalse(provider.reload())
+        self.assertEqual(provider.index.principals('babara'),
+                         frozenset(['g:grp_sol', 'g:grp_luna']))
+
+    def test_watch(self):
+        from .groups import FileGroupProvider
+        self.write_groups(json.dumps({}))
+        provider = FileGroupProvider(self.path, interval=0.01)
+        provider.start()
+        self.addCleanup(provider.stop)
+        self.write_groups(json.dumps({'grp_sol': ['aaron']}))
+        for i in range(100):
+            if provider.index.principals('aaron'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(provider.index.principals('aaron'),
+                         frozenset(['g:grp_sol']))
+
+    def test_watch_survives_errors(self):
+        from .groups import FileGroupProvider
+        self.write_groups(json.dumps({}))
+        provider = FileGroupProvider(self.path, interval=0.01)
+        reload = provider.reload
+        failures = []
+
+        def failing_reload():
+            if not failures:
+                failures.append(None)
+                raise RuntimeError('unexpected')
+            return reload()
+
+        provider.reload = failing_reload
+        provider.start()
+        self.addCleanup(provider.stop)
+        self.write_groups(json.dumps({'grp_sol': ['aaron']}))
+        for i in range(100):
+            if provider.index.principals('aaron'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(failures, [None])
+        self.assertEqual(provider.index.principals('aaron'),
+                         frozenset(['g:grp_sol']))
+
+
+class GroupsIncludemeTests(unittest.TestCase):
+
+    def include(self, **settings):
+        from pyramid import testing
+        config = testing.setUp(settings=dict(
+            ('openstax_accounts.{}'.format(name), value)
+            for name, value in settings.items()))
+        self.addCleanup(testing.tearDown)
+        config.include('openstax_accounts.groups')
+
+    def test_conflicting_sources(self):
+        with self.assertRaises(ValueError):
+            self.include(groups_file='groups.json',
+                         groups_from_accounts='true')
+
+    def test_accounts_with_stub(self):
+        with self.assertRaises(ValueError):
+            self.include(stub='true', groups_from_accounts='true')
+
+
+class MemoizedPrincipalsTests(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid import testing
+        self.config = testing.setUp(settings={
+            'openstax_accounts.login_path': '/login',
+            'openstax_accounts.callback_path': '/callback',
+            'openstax_accounts.groups.grp_sol': 'aaron',
+            })
+        self.addCleanup(testing.tearDown)
+
+    def test_stub_policy(self):
+        from pyramid import testing
+        from .stub import StubAuthenticationPolicy
+        policy = StubAuthenticationPolicy({
+            'aaron': {'password': 'password', 'profile': {}}})
+        request = testing.DummyRequest(path='/')
+        principals = policy.effective_principals(request)
+        self.assertEqual(len(principals), 1)
+        self.assertTrue(policy.effective_principals(request) is principals)
+        # Logging in forgets the principals of the anonymous user.
+        policy.remember(request, 'aaron', profile={'username': 'aaron'})
+        self.assertEqual(policy.authenticated_userid(request), 'aaron')
+        self.assertTrue('g:grp_sol' in policy.effective_principals(request))
+        policy.forget(request)
+        self.assertEqual(policy.authenticated_userid(request), None)
+
+    def test_callback_exchanges_code_once(self):
+        from pyramid import testing
+        from .authentication_policy import OpenstaxAccountsAuthenticationPolicy
+        calls = []
+
+        class AccountsClient(object):
+            access_token = 'user-token'
+
+            def request_token_with_code(self, code):
+                calls.append(code)
+
+            def get_profile(self):
+                return {'username': 'aaron'}
+
+        policy = OpenstaxAccountsAuthenticationPolicy(
+            'http://localhost:8000/', '/login', '/callback', '/logout')
+        request = testing.DummyRequest(path='/callback',
+                                       params={'code': 'abc'})
+        request.accounts_client = AccountsClient()
+        for i in range(3):
+            self.assertEqual(policy.authenticated_userid(request), 'aaron')
+            self.assertTrue('g:grp_sol' in
+                            policy.effective_principals(request))
+        self.assertEqual(calls, ['abc'])
+
+
+class ProfileStoreTests(unittest.TestCase):
+
+    def assert_store(self, store):
+        self.assertEqual(store.get('aaron'), (None, None))
+        self.assertEqual(store.set('aaron', {'username': 'aaron'}), 1)
+        self.assertEqual(store.set('aaron', {'username': 'aaron', 'id': 1}),
+                         2)
+        self.assertEqual(store.get('aaron'),
+                         (2, {'username': 'aaron', 'id': 1}))
+        store.delete('aaron')
+        self.assertEqual(store.get('aaron'), (None, None))
+
+    def test_memory_store(self):
+        from .profile_store import MemoryProfileStore
+        self.assert_store(MemoryProfileStore())
+
+    def test_sqlite_store(self):
+        import shutil
+        import tempfile
+        from .profile_store import SQLiteProfileStore
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'profiles.sqlite')
+        self.assert_store(SQLiteProfileStore(path))
+        # The profiles are shared with other stores (processes).
+        SQLiteProfileStore(path).set('babara', {'username': 'babara'})
+        self.assertEqual(SQLiteProfileStore(path).get('babara'),
+                         (1, {'username': 'babara'}))
+
+    def test_remember_profile(self):
+        from pyramid import testing
+        from .interfaces import IProfileStore
+        from .profile_store import (
+            MemoryProfileStore, load_profile, remember_profile)
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        request = testing.DummyRequest()
+        # Without a store the profile is kept in the session.
+        remember_profile(request, {'username': 'aaron'})
+        self.assertEqual(request.session['profile'], {'username': 'aaron'})
+        self.assertEqual(load_profile(request), {'username': 'aaron'})
+
+        store = MemoryProfileStore()
+        config.registry.registerUtility(store, IProfileStore)
+        remember_profile(request, {'username': 'aaron', 'id': 1})
+        self.assertEqual(dict(request.session), {
+            'username': 'aaron',
+            'profile_key': 'aaron',
+            'profile_version': 1,
+            })
+        self.assertEqual(load_profile(request), {'username': 'aaron', 'id': 1})
+        # A store that only has an older version has lost the profile.
+        store.delete('aaron')
+        store.set('aaron', {'username': 'aaron'})
+        request.session['profile_version'] = 2
+        self.assertEqual(load_profile(request), None)
+
+
+class QueuedMessageSenderTests(unittest.TestCase):
+
+    def make_one(self, send, **kwargs):
+        from .openstax_accounts import QueuedMessageSender
+        sender = QueuedMessageSender(send=send, **kwargs)
+        self.addCleanup(sender.close)
+        return sender
+
+    def test_send_and_close(self):
+        sent = []
+
+        def send(msg_data):
+            if msg_data['subject'] == 'fail':
+                raise ValueError(msg_data)
+            time.sleep(0.01)
+            sent.append(msg_data['subject'])
+
+        sender = self.make_one(send, workers=3)
+        for i in range(10):
+            sender({'subject': str(i)})
+        sender({'subject': 'fail'})
+        sender.close()
+        # All the queued messages are sent before the workers stop.
+        self.assertEqual(sorted(sent, key=int), [str(i) for i in range(10)])
+        stats = sender.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['dropped']),
+                         (10, 1, 0))
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertTrue(stats['latency_max'] >= 0.01)
+        with self.assertRaises(RuntimeError):
+            sender({'subject': 'too late'})
+
+    def make_stalled(self, **kwargs):
+        # Returns a sender whose single worker is stuck sending a message.
+        started = threading.Event()
+        release = threading.Event()
+
+        def send(msg_data):
+            started.set()
+            release.wait()
+
+        sender = self.make_one(send, workers=1, **kwargs)
+        self.addCleanup(release.set)
+        sender({'subject': 'stalled'})
+        started.wait()
+        return sender
+
+    def test_drop_when_full(self):
+        sender = self.make_stalled(queue_size=2, block=False)
+        for i in range(4):
+            sender({'subject': str(i)})
+        stats = sender.stats()
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['queue_depth'], 2)
+
+    def test_block_timeout(self):
+        sender = self.make_stalled(queue_size=1, block_timeout=0.01)
+        for i in range(2):
+            sender({'subject': str(i)})
+        self.assertEqual(sender.stats()['dropped'], 1)
+
+
+class BaseOpenstaxAccountsTests(unittest.TestCase):
+    """Runs the accounts client against a ``FakeAccountsServer``."""
+
+    def setUp(self):
+        self.server = FakeAccountsServer()
+        self.addCleanup(self.server.stop)
+        self.server.route('POST', '/oauth/token', {
+            'access_token': 'app-token',
+            'expires_in': None,
+            })
+
+    def make_one(self, **kwargs):
+        from .openstax_accounts import OpenstaxAccounts
+        settings = {
+            'server_url': self.server.url,
+            'application_id': 'app-id',
+            'application_secret': 'app-secret',
+            'application_url': 'http://localhost:8000/',
+            }
+        settings.update(kwargs)
+        OpenstaxAccounts.singleton(settings)
+        self.addCleanup(setattr, OpenstaxAccounts, 'transport', None)
+        self.addCleanup(OpenstaxAccounts.transport.close)
+        return OpenstaxAccounts()
+
+    def route_search(self, users, max_per_page=None):
+        def search(handler):
+            page = int(handler.query['page'])
+            per_page = min(int(handler.query['per_page']),
+                           max_per_page or float('inf'))
+            items = users[(page - 1) * per_page:page * per_page]
+            return 200, {}, {'items': items, 'total_count': len(users)}
+
+        self.server.route('GET', '/api/application_users.json', search)
+
+    def route_profiles(self, usernames, delay=0):
+        def find(username):
+            def respond(handler):
+                time.sleep(delay)
+                return 200, {}, {'user': {'username': username}}
+            return respond
+
+        for username in usernames:
+            self.server.route(
+                'GET', '/api/application_users/find/username/' + username,
+                find(username))
+
+    def route_send_message(self, users):
+        self.server.route('GET', '/api/users.json', lambda handler: (
+            200, {}, {'items': [
+                {'id': users[name], 'username': name}
+                for name in handler.query['q'].split(':', 1)[1].split(',')
+                if name in users]}))
+
+        def create_message(handler):
+            data = urlparse.parse_qs(handler.body.decode('utf-8'))
+            if data['user_id'][0] not in [str(i) for i in users.values()]:
+                return 422, {}, {'error': 'unknown user'}
+            return 201, {}, {}
+
+        self.server.route('POST', '/api/messages.json', create_message)
+
+    def route_update_profile(self, put_body=b''):
+        self.server.route('PUT', '/api/user.json', put_body,
+                          status=200 if put_body else 204)
+        self.server.route('POST', '/api/contact_infos.json', lambda handler: (
+            201, {}, dict(json.loads(handler.body.decode('utf-8')), id=2)))
+
+    def make_profile_request(self):
+        from pyramid import testing
+        request = testing.DummyRequest()
+        request.user = {
+            'username': 'aaron',
+            'first_name': 'Aaron',
+            'contact_infos': [
+                {'id': 1, 'type': 'EmailAddress', 'value': 'a@example.org'},
+                ],
+            }
+        return request
+
+    def set_up_message_sender(self):
+        from pyramid import testing
+        from .interfaces import IMessageSender
+        from .openstax_accounts import send_message
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.registry.registerUtility(send_message, IMessageSender)
+        return config
+
+
+class OpenstaxAccountsTests(BaseOpenstaxAccountsTests):
+
+    def test_request_application_token(self):
+        accounts = self.make_one()
+        accounts.request_application_token()
+        self.assertEqual(accounts.access_token, 'app-token')
+        self.assertFalse(hasattr(accounts.sanction_client, 'expires_in'))
+        method, path, query = self.server.requests[0]
+        self.assertEqual((method, path), ('POST', '/oauth/token'))
+
+    def test_request_shares_pool(self):
+        from .openstax_accounts import OpenstaxAccounts
+        self.server.route('GET', '/api/users.json',
+                          {'items': [], 'total_count': 0})
+        accounts = self.make_one(pool_size='3')
+        self.assertEqual(accounts.transport.pool_size, 3)
+        accounts.request_application_token()
+        other = OpenstaxAccounts()
+        other.access_token = 'user-token'
+        accounts.global_search('username:aaron')
+        other.global_search('username:aaron')
+        self.assertTrue(other.transport is accounts.transport)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests[-2][2], {
+            'q': 'username:aaron', 'access_token': 'app-token'})
+        self.assertEqual(self.server.requests[-1][2], {
+            'q': 'username:aaron', 'access_token': 'user-token'})
+
+    def test_bind(self):
+        from pyramid import testing
+        from .authentication_policy import get_accounts_client
+        from .interfaces import IOpenstaxAccounts
+        from .openstax_accounts import ApplicationToken
+        self.server.route('GET', '/api/user.json', {'id': 1})
+        accounts = self.make_one()
+        accounts.application_token = ApplicationToken(accounts)
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.registry.registerUtility(accounts, IOpenstaxAccounts)
+        request = testing.DummyRequest()
+        request.session['access_token'] = 'user-token'
+
+        client = get_accounts_client(request)
+        self.assertEqual(client.access_token, 'user-token')
+        self.assertTrue(client.transport is accounts.transport)
+        self.assertEqual(client.auth_uri(), accounts.auth_uri())
+        self.assertEqual(client.get_profile(), {'id': 1})
+        self.assertEqual(self.server.requests[-1][2],
+                         {'access_token': 'user-token'})
+        # The process-wide client still uses the application's token.
+        self.assertEqual(accounts.get_profile(), {'id': 1})
+        self.assertEqual(self.server.requests[-1][2],
+                         {'access_token': 'app-token'})
+
+        del request.session['access_token']
+        client = get_accounts_client(request)
+        self.assertEqual(client.access_token, None)
+
+    def test_iter_search(self):
+        users = [{'id': i, 'username': 'user{}'.format(i)}
+                 for i in range(25)]
+        self.route_search(users)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        for prefetch in (0, 2):
+            del self.server.requests[:]
+            self.assertEqual(list(accounts.iter_search(
+                '%', page_size=10, prefetch=prefetch, order_by='username')),
+                users)
+            self.assertEqual([(query['page'], query['order_by'])
+                              for method, path, query in self.server.requests],
+                             [('1', 'username'), ('2', 'username'),
+                              ('3', 'username')])
+
+        del users[20:]
+        del self.server.requests[:]
+        self.assertEqual(len(list(accounts.iter_search('%', page_size=10))),
+                         20)
+        # The total count says there are no more pages.
+        self.assertEqual(len(self.server.requests), 2)
+        # The pages are not cached.
+        self.assertEqual(len(accounts.search_cache), 0)
+
+    def test_iter_search_capped_page_size(self):
+        users = [{'id': i, 'username': 'user{}'.format(i)}
+                 for i in range(250)]
+        self.route_search(users, max_per_page=50)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        del self.server.requests[:]
+        self.assertEqual(list(accounts.iter_search('%', page_size=100)),
+                         users)
+        self.assertEqual([(query['page'], query['per_page'])
+                          for method, path, query in self.server.requests],
+                         [('1', '100'), ('2', '50'), ('3', '50'),
+                          ('4', '50'), ('5', '50')])
+
+    def test_get_profiles_by_usernames(self):
+        usernames = ['user{}'.format(i) for i in range(20)]
+        self.route_profiles(usernames, delay=0.05)
+        accounts = self.make_one(lookup_concurrency='10')
+        accounts.request_application_token()
+        accounts.get_profile_by_username('user0')
+        profiles = accounts.get_profiles_by_usernames(
+            usernames + ['nobody', 'user1'], max_workers=20)
+        expected = dict((username, {'username': username})
+                        for username in usernames)
+        expected['nobody'] = None
+        self.assertEqual(profiles, expected)
+        # The 20 lookups (user0 is cached) run concurrently, but at most
+        # 10 at a time.
+        self.assertTrue(1 < self.server.peak_in_flight <= 10,
+                        self.server.peak_in_flight)
+        self.assertEqual(len(self.server.requests), 22)
+
+        # The pool is reused, and used by at most ``max_workers`` threads.
+        pool = accounts.lookup_pool
+        self.server.peak_in_flight = 0
+        accounts.profile_cache.clear()
+        del expected['nobody']
+        self.assertEqual(accounts.get_profiles_by_usernames(
+            usernames, max_workers=3), expected)
+        self.assertTrue(accounts.lookup_pool is pool)
+        self.assertTrue(1 < self.server.peak_in_flight <= 3,
+                        self.server.peak_in_flight)
+        self.server.peak_in_flight = 0
+        accounts.profile_cache.clear()
+        self.assertEqual(accounts.get_profiles_by_usernames(
+            usernames[:3], max_workers=0), {
+                'user0': {'username': 'user0'},
+                'user1': {'username': 'user1'},
+                'user2': {'username': 'user2'}})
+        self.assertEqual(self.server.peak_in_flight, 1)
+
+    def test_timeout_and_retries(self):
+        import socket
+        attempts = []
+
+        def flaky(handler):
+            attempts.append(None)
+            if len(attempts) < 3:
+                time.sleep(0.2)
+            return 200, {}, {'id': 1}
+
+        self.server.route('GET', '/api/user.json', flaky)
+        accounts = self.make_one(**{'timeout.profile': '0.05',
+                                    'retry_backoff': '0.01'})
+        accounts.request_application_token()
+        self.assertEqual(accounts.get_profile(), {'id': 1})
+        self.assertEqual(len(attempts), 3)
+
+        del attempts[:]
+        accounts.retries = 1
+        with self.assertRaises(socket.timeout):
+            accounts.get_profile()
+        self.assertEqual(len(attempts), 2)
+
+    def test_no_retry_post(self):
+        self.server.route('POST', '/api/messages.json', {}, status=503)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        from .transport import HTTPError
+        with self.assertRaises(HTTPError):
+            accounts.request('/api/messages.json', data='a=b')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_circuit_breaker(self):
+        from .resilience import CircuitOpenError
+        from .transport import HTTPError
+        self.server.route('GET', '/api/application_users/find/username/aaron',
+                          {'user': {'username': 'aaron'}})
+        accounts = self.make_one(**{
+            'retries': '0',
+            'profile_cache.ttl': '0.01',
+            'circuit_breaker.failure_threshold': '2',
+            })
+        accounts.request_application_token()
+        self.assertEqual(accounts.get_profile_by_username('aaron'),
+                         {'username': 'aaron'})
+        time.sleep(0.02)
+
+        self.server.route('GET', '/api/user.json', {}, status=500)
+        for i in range(2):
+            with self.assertRaises(HTTPError):
+                accounts.get_profile()
+        requests = len(self.server.requests)
+        with self.assertRaises(CircuitOpenError):
+            accounts.get_profile()
+        # The expired profile is served while the circuit is open.
+        self.assertEqual(accounts.get_profile_by_username('aaron'),
+                         {'username': 'aaron'})
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_metrics(self):
+        self.server.route('GET', '/api/user.json', {'id': 1})
+        self.server.route('GET', '/api/users.json', {}, status=404)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        accounts.get_profile()
+        from .transport import HTTPError
+        with self.assertRaises(HTTPError):
+            accounts.global_search('username:aaron')
+        snapshot = accounts.metrics.snapshot()
+        self.assertEqual(sorted(snapshot),
+                         ['global_search', 'profile', 'token'])
+        self.assertEqual(snapshot['profile']['requests'], 1)
+        self.assertEqual(snapshot['profile']['errors'], {})
+        self.assertEqual(snapshot['profile']['size']['sum'], len('{"id": 1}'))
+        self.assertEqual(snapshot['global_search']['errors'],
+                         {'HTTP 404': 1})
+
+    def test_conditional_get_profile(self):
+        self.server.etags = True
+        self.server.route('GET', '/api/user.json', {'id': 1})
+        accounts = self.make_one()
+        accounts.request_application_token()
+        profile = accounts.get_profile()
+        self.assertEqual(profile, {'id': 1})
+        profile['contact_infos'] = []
+        # Callers get copies, the cached profile is not modified.
+        self.assertEqual(accounts.get_profile(), {'id': 1})
+        self.assertEqual(self.server.statuses[-2:], [200, 304])
+        accounts.get_profile()['contact_infos'] = []
+        self.assertEqual(accounts.get_profile(), {'id': 1})
+
+        # Validators are kept per user.
+        client = accounts.bind('user-token')
+        self.assertEqual(client.get_profile(), {'id': 1})
+        self.assertEqual(self.server.statuses[-1], 200)
+
+        self.server.route('GET', '/api/user.json', {'id': 1, 'name': 'x'})
+        self.assertEqual(accounts.get_profile(), {'id': 1, 'name': 'x'})
+        self.assertEqual(self.server.statuses[-1], 200)
+
+    def test_conditional_last_modified(self):
+        path = '/api/application_users/find/username/aaron'
+        self.server.route('GET', path, {'user': {'username': 'aaron'}},
+                          headers={'Last-Modified':
+                                   'Wed, 21 Oct 2015 07:28:00 GMT'})
+        accounts = self.make_one(**{'profile_cache.ttl': '0.01'})
+        accounts.request_application_token()
+        for i in range(2):
+            self.assertEqual(accounts.get_profile_by_username('aaron'),
+                             {'username': 'aaron'})
+            time.sleep(0.02)
+        self.assertEqual(self.server.statuses[-2:], [200, 304])
+
+    def test_update_profile(self):
+        self.route_update_profile()
+        accounts = self.make_one()
+        accounts.request_application_token()
+        request = self.make_profile_request()
+        accounts.update_profile(request, first_name='Aaron A.',
+                                email='a@example.org')
+        # The email address has not changed, the profile is merged locally.
+        self.assertEqual([path for method, path, query
+                          in self.server.requests[1:]], ['/api/user.json'])
+        self.assertEqual(request.session['profile']['first_name'],
+                         'Aaron A.')
+        self.assertEqual(request.session['username'], 'aaron')
+
+        request = self.make_profile_request()
+        accounts.update_profile(request, email='aaron@example.org')
+        self.assertEqual(sorted(path for method, path, query
+                                in self.server.requests[2:]),
+                         ['/api/contact_infos.json', '/api/user.json'])
+        self.assertEqual(email_values(request.session['profile']),
+                         ['a@example.org', 'aaron@example.org'])
+
+    def test_update_profile_email_error(self):
+        from .transport import HTTPError
+        self.route_update_profile({'username': 'aaron', 'first_name': 'A.'})
+        self.server.route('POST', '/api/contact_infos.json', {}, status=422)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        request = self.make_profile_request()
+        with self.assertRaises(HTTPError):
+            accounts.update_profile(request, first_name='A.',
+                                    email='aaron@example.org')
+        # The profile update is remembered nonetheless.
+        self.assertEqual(request.session['profile'],
+                         {'username': 'aaron', 'first_name': 'A.'})
+
+    def test_update_profile_response(self):
+        self.route_update_profile({'username': 'aaron', 'first_name': 'A.'})
+        accounts = self.make_one()
+        accounts.request_application_token()
+        request = self.make_profile_request()
+        accounts.update_profile(request, first_name='A.')
+        self.assertEqual(request.session['profile'],
+                         {'username': 'aaron', 'first_name': 'A.'})
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_user_refetched_from_store_miss(self):
+        from pyramid import testing
+        from .authentication_policy import get_user_from_session
+        from .interfaces import IOpenstaxAccounts, IProfileStore
+        from .profile_store import MemoryProfileStore
+        self.server.route('GET', '/api/user.json', {'username': 'aaron'})
+        accounts = self.make_one()
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.registry.registerUtility(accounts, IOpenstaxAccounts)
+        store = MemoryProfileStore()
+        config.registry.registerUtility(store, IProfileStore)
+        request = testing.DummyRequest()
+        request.accounts_client = accounts.bind('user-token')
+        request.session.update({
+            'username': 'aaron',
+            'profile_key': 'aaron',
+            'profile_version': 1,
+            'access_token': 'user-token',
+            })
+        self.assertEqual(get_user_from_session(request),
+                         {'username': 'aaron'})
+        self.assertEqual(store.get('aaron'), (1, {'username': 'aaron'}))
+        self.assertEqual(len(self.server.requests), 1)
+
+        # The profile can not be fetched with an expired token.
+        store.delete('aaron')
+        self.server.route('GET', '/api/user.json', {}, status=401)
+        request = testing.DummyRequest()
+        request.accounts_client = accounts.bind('expired-token')
+        request.session.update({
+            'username': 'aaron',
+            'profile_key': 'aaron',
+            'profile_version': 1,
+            'access_token': 'expired-token',
+            })
+        self.assertEqual(get_user_from_session(request), None)
+
+    def test_accounts_group_provider(self):
+        from .groups import AccountsGroupProvider
+        self.server.route('GET', '/api/groups.json', [
+            {'name': 'grp_sol', 'members': [
+                {'user': {'id': 1, 'username': 'aaron'}},
+                {'user': {'id': 2, 'username': 'babara'}},
+                ]},
+            {'name': None, 'members': []},
+            ])
+        accounts = self.make_one()
+        accounts.request_application_token()
+        provider = AccountsGroupProvider(accounts, interval=0.01,
+                                         groups={'grp_luna': ['babara']})
+        self.assertEqual(provider.index.principals('aaron'), frozenset())
+        provider.start()
+        self.addCleanup(provider.stop)
+        for i in range(100):
+            if provider.last_reload is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(provider.index.principals('babara'),
+                         frozenset(['g:grp_sol', 'g:grp_luna']))
+        provider.stop()
+
+        # The last good membership is served while accounts fails.
+        self.server.route('GET', '/api/groups.json', {}, status=500)
+        accounts.retries = 0
+        self.assertFalse(provider.reload())
+        self.assertEqual(provider.index.principals('aaron'),
+                         frozenset(['g:grp_sol']))
+
+    def test_hedged_profile_lookup(self):
+        calls = []
+        release = threading.Event()
+
+        def find(handler):
+            calls.append(None)
+            call = len(calls)
+            if call == 1:
+                # Answers once the hedged request has been answered.
+                release.wait(5)
+            return 200, {}, {'user': {'username': 'aaron', 'call': call}}
+
+        self.server.route('GET', '/api/application_users/find/username/aaron',
+                          find)
+        accounts = self.make_one(hedge_after='0.02')
+        accounts.request_application_token()
+        try:
+            self.assertEqual(accounts.get_profile_by_username('aaron'),
+                             {'username': 'aaron', 'call': 2})
+        finally:
+            release.set()
+        self.assertEqual(len(calls), 2)
+
+    def test_search_cache(self):
+        self.server.route('GET', '/api/application_users.json', lambda h: (
+            200, {}, {'items': [], 'total_count': 0, 'q': h.query['q']}))
+        self.server.route('GET', '/api/users.json',
+                          {'items': [], 'total_count': 0})
+        accounts = self.make_one(**{'search_cache.max_bytes': '1000'})
+        accounts.request_application_token()
+        accounts.search('first_name:Test', order_by='last_name')
+        accounts.search('  first_name:Test ', order_by='last_name asc')
+        accounts.search('first_name:Test', order_by='last_name  ASC',
+                        per_page=10)
+        accounts.search('first_name:Test', per_page=10,
+                        order_by='last_name')
+        accounts.global_search('first_name:Test')
+        accounts.global_search('first_name:Test ')
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertTrue(0 < accounts.search_cache.bytes <= 1000)
+
+        accounts.invalidate_search_cache(' first_name:Test')
+        accounts.global_search('first_name:Test')
+        self.assertEqual(len(self.server.requests), 5)
+        accounts.invalidate_search_cache()
+        self.assertEqual(len(accounts.search_cache), 0)
+
+    def test_search_cache_copies(self):
+        self.server.route('GET', '/api/users.json', {
+            'items': [{'id': 1, 'username': 'aaron'}], 'total_count': 1})
+        accounts = self.make_one()
+        accounts.request_application_token()
+        results = accounts.global_search('username:aaron')
+        results['items'].pop()
+        # Callers get copies, the cached results are not modified.
+        self.assertEqual(accounts.global_search('username:aaron'), {
+            'items': [{'id': 1, 'username': 'aaron'}], 'total_count': 1})
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_endpoint_name(self):
+        from .openstax_accounts import endpoint_name
+        self.assertEqual(endpoint_name(
+            'https://localhost:3000//api/user.json?access_token=x'),
+            'profile')
+        self.assertEqual(endpoint_name(
+            '/api/application_users/find/username/aaron'),
+            'profile_by_username')
+        self.assertEqual(endpoint_name('/api/unknown'), 'other')
+
+    def test_normalize_order_by(self):
+        from .openstax_accounts import normalize_order_by
+        self.assertEqual(normalize_order_by(' first_name, last_name desc,'),
+                         'first_name ASC,last_name DESC')
+
+    def test_get_profile_by_username_cached(self):
+        self.server.route('GET', '/api/application_users/find/username/aaron',
+                          {'user': {'id': 1, 'username': 'aaron'}})
+        accounts = self.make_one(**{'profile_cache.size': '10'})
+        accounts.request_application_token()
+        for i in range(3):
+            self.assertEqual(accounts.get_profile_by_username('aaron'),
+                             {'id': 1, 'username': 'aaron'})
+            self.assertEqual(accounts.get_profile_by_username('nobody'),
+                             None)
+        # Only the first lookups go to the server, including the miss.
+        self.assertEqual(len(self.server.requests), 3)
+        stats = accounts.profile_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 2))
+
+    def test_get_profile_by_username_cache_scope(self):
+        from .openstax_accounts import OpenstaxAccounts
+        self.server.route('GET', '/api/application_users/find/username/aaron',
+                          {'user': {'id': 1, 'username': 'aaron'}})
+        accounts = self.make_one(**{'profile_cache.size': '10'})
+        accounts.request_application_token()
+        profile = accounts.get_profile_by_username('aaron')
+        profile['username'] = 'changed'
+        # Callers get copies, the cached profile is not modified.
+        self.assertEqual(accounts.get_profile_by_username('aaron'),
+                         {'id': 1, 'username': 'aaron'})
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Other users do not see the profiles cached for the application.
+        other = OpenstaxAccounts()
+        other.access_token = 'user-token'
+        self.assertEqual(other.get_profile_by_username('aaron'),
+                         {'id': 1, 'username': 'aaron'})
+        self.assertEqual(self.server.requests[-1][2],
+                         {'access_token': 'user-token'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_send_message_cached_userid(self):
+        self.route_send_message({'aaron': 1})
+        config = self.set_up_message_sender()
+        accounts = self.make_one()
+        accounts.request_application_token()
+        from .interfaces import IOpenstaxAccounts
+        config.registry.registerUtility(accounts, IOpenstaxAccounts)
+
+        accounts.send_message('aaron', 'Hi', 'Hello')
+        accounts.send_message('aaron', 'Hi', 'Hello again')
+        paths = [path for method, path, query in self.server.requests]
+        self.assertEqual(paths, ['/oauth/token', '/api/users.json',
+                                 '/api/messages.json', '/api/messages.json'])
+
+    def test_send_message_stale_userid(self):
+        self.route_send_message({'aaron': 1})
+        config = self.set_up_message_sender()
+        accounts = self.make_one()
+        accounts.request_application_token()
+        from .interfaces import IOpenstaxAccounts
+        config.registry.registerUtility(accounts, IOpenstaxAccounts)
+        accounts.userid_cache.set('aaron', 99)
+
+        accounts.send_message('aaron', 'Hi', 'Hello')
+        paths = [path for method, path, query in self.server.requests]
+        self.assertEqual(paths, ['/oauth/token', '/api/messages.json',
+                                 '/api/users.json', '/api/messages.json'])
+        self.assertEqual(accounts.userid_cache.get('aaron'), 1)
+
+    def route_prefix_search(self, users, per_page=5):
+        # Matches usernames by prefix, like accounts, ordered by id.
+        def search(handler):
+            prefixes = handler.query['q'].split(':', 1)[1].split(',')
+            matches = sorted(
+                (userid, name) for name, userid in users.items()
+                if any(name.startswith(prefix) for prefix in prefixes))
+            page = int(handler.query.get('page', 1))
+            items = [{'id': userid, 'username': name} for userid, name
+                     in matches[(page - 1) * per_page:page * per_page]]
+            return 200, {}, {'items': items, 'total_count': len(matches)}
+
+        self.server.route('GET', '/api/users.json', search)
+
+    def test_resolve_userids_pages(self):
+        from .openstax_accounts import lookup_userid, resolve_userids
+        users = dict(('aaron{}'.format(i), i) for i in range(1, 13))
+        users.update({'aaron': 20, 'babara': 21})
+        self.route_prefix_search(users)
+        accounts = self.make_one()
+        accounts.request_application_token()
+        del self.server.requests[:]
+        self.assertEqual(
+            resolve_userids(accounts, ['aaron', 'babara', 'nobody']),
+            {'aaron': 20, 'babara': 21})
+        # "aaron" is on the third page.
+        self.assertEqual([query.get('page') for method, path, query
+                          in self.server.requests], [None, '2', '3'])
+        accounts.userid_cache.clear()
+        self.assertEqual(lookup_userid(accounts, 'aaron'), 20)
+
+    def test_send_messages(self):
+        from .openstax_accounts import UserNotFoundException
+        self.route_send_message({'aaron': 1, 'babara': 2, 'caitlin': 3})
+        config = self.set_up_message_sender()
+        accounts = self.make_one(message_batch_size='2')
+        accounts.request_application_token()
+        from .interfaces import IOpenstaxAccounts
+        config.registry.registerUtility(accounts, IOpenstaxAccounts)
+
+        results = accounts.send_messages(
+            ['aaron', 'babara', 'nobody', 'caitlin', 'aaron'], 'Hi', 'Hello')
+        self.assertEqual(sorted(results), ['aaron', 'babara', 'caitlin',
+                                           'nobody'])
+        self.assertTrue(isinstance(results.pop('nobody'),
+                                   UserNotFoundException))
+        self.assertEqual(set(results.values()), set([True]))
+        paths = [path for method, path, query in self.server.requests]
+        self.assertEqual(paths, ['/oauth/token', '/api/users.json',
+                                 '/api/messages.json', '/api/messages.json'])
+
+    def test_send_message_user_not_found(self):
+        from .openstax_accounts import UserNotFoundException
+        self.route_send_message({'aaron': 1})
+        self.set_up_message_sender()
+        accounts = self.make_one()
+        accounts.request_application_token()
+        with self.assertRaises(UserNotFoundException):
+            accounts.send_message('nobody', 'Hi', 'Hello')
+
+
+class ApplicationTokenTests(BaseOpenstaxAccountsTests):
+
+    def setUp(self):
+        BaseOpenstaxAccountsTests.setUp(self)
+        self.tokens = []
+        self.fetching = threading.Event()
+
+        def token(handler):
+            self.fetching.wait()
+            self.tokens.append('token-{}'.format(len(self.tokens)))
+            return 200, {}, {'access_token': self.tokens[-1],
+                             'expires_in': self.expires_in}
+
+        self.expires_in = 3600
+        self.server.route('POST', '/oauth/token', token)
+        self.server.route('GET', '/api/user.json', lambda handler: (
+            200, {}, {'token': handler.query['access_token']}))
+
+    def make_one(self, **kwargs):
+        from .openstax_accounts import ApplicationToken
+        accounts = BaseOpenstaxAccountsTests.make_one(self)
+        accounts.application_token = ApplicationToken(accounts, **kwargs)
+        self.addCleanup(accounts.application_token.stop)
+        return accounts
+
+    def test_lazy_fetch(self):
+        self.fetching.set()
+        accounts = self.make_one()
+        self.assertEqual(accounts.access_token, None)
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(accounts.get_profile(), {'token': 'token-0'})
+        self.assertEqual(accounts.get_profile(), {'token': 'token-0'})
+        self.assertEqual(accounts.access_token, 'token-0')
+        self.assertEqual(self.tokens, ['token-0'])
+
+    def test_single_concurrent_fetch(self):
+        accounts = self.make_one()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(accounts.get_profile()['token']))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        self.fetching.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['token-0'] * 5)
+        self.assertEqual(self.tokens, ['token-0'])
+
+    def test_refresh_before_expiry(self):
+        self.fetching.set()
+        self.expires_in = 61
+        accounts = self.make_one(refresh_margin=61)
+        self.assertEqual(accounts.get_profile(), {'token': 'token-0'})
+        # Still valid, but within the refresh margin.
+        self.assertEqual(accounts.get_profile(), {'token': 'token-1'})
+        self.expires_in = None
+        self.assertEqual(accounts.get_profile(), {'token': 'token-2'})
+        self.assertEqual(accounts.get_profile(), {'token': 'token-2'})
+        self.assertEqual(accounts.application_token.expires, None)
+
+    def test_refresh_rejected_token(self):
+        self.fetching.set()
+        accounts = self.make_one()
+        accounts.application_token.access_token = 'revoked'
+        self.server.route('GET', '/api/user.json', lambda handler: (
+            (401, {}, {}) if handler.query['access_token'] == 'revoked'
+            else (200, {}, {'token': handler.query['access_token']})))
+        self.assertEqual(accounts.get_profile(), {'token': 'token-0'})
+
+    def test_background(self):
+        self.fetching.set()
+        accounts = self.make_one()
+        accounts.application_token.start()
+        for i in range(100):
+            if accounts.access_token:
+                break
+            time.sleep(0.01)
+        self.assertEqual(accounts.access_token, 'token-0')
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'requires asyncio')
+class AsyncOpenstaxAccountsTests(BaseOpenstaxAccountsTests):
+
+    def make_one(self, **kwargs):
+        import asyncio
+        from .aio import AsyncOpenstaxAccounts
+        # Configure the settings the async client reuses.
+        BaseOpenstaxAccountsTests.make_one(self, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        accounts = AsyncOpenstaxAccounts()
+        self.addCleanup(accounts.close)
+        return accounts
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_concurrent_lookups(self):
+        import asyncio
+        usernames = ['user{}'.format(i) for i in range(50)]
+        for username in usernames:
+            self.server.route(
+                'GET', '/api/application_users/find/username/' + username,
+                {'user': {'username': username}})
+        accounts = self.make_one(pool_size='5')
+        self.run_until_complete(accounts.request_application_token())
+        self.assertEqual(accounts.access_token, 'app-token')
+        profiles = self.run_until_complete(asyncio.gather(*[
+            accounts.get_profile_by_username(username)
+            for username in usernames + ['nobody']]))
+        self.assertEqual([profile and profile['username']
+                          for profile in profiles], usernames + [None])
+        self.assertEqual(len(self.server.requests), 52)
+        # Idle connections beyond the pool size are closed.
+        self.assertEqual(len(accounts.transport._pools.popitem()[1]), 5)
+
+    def test_post_not_replayed(self):
+        import socket
+        posted = []
+
+        def reset(handler):
+            posted.append(handler.body)
+            # Drop the connection once the request has been received.
+            raise socket.error('connection reset')
+
+        self.server.route('GET', '/api/user.json', {'username': 'aaron'})
+        self.server.route('POST', '/api/messages.json', reset)
+        self.server.handle_error = lambda request, client_address: None
+        transport = self.make_one().transport
+        self.run_until_complete(transport.request(
+            'GET', urlparse.urljoin(self.server.url, '/api/user.json')))
+        with self.assertRaises(ConnectionError):
+            self.run_until_complete(transport.request(
+                'POST', urlparse.urljoin(self.server.url,
+                                         '/api/messages.json'),
+                body='subject=Hi'))
+        self.assertEqual(posted, [b'subject=Hi'])
+
+    def test_update_profile(self):
+        from .transport import HTTPError
+        self.route_update_profile()
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+        request = self.make_profile_request()
+        self.run_until_complete(accounts.update_profile(
+            request, first_name='A.', email='aaron@example.org'))
+        self.assertEqual(sorted(path for method, path, query
+                                in self.server.requests[1:]),
+                         ['/api/contact_infos.json', '/api/user.json'])
+        self.assertEqual(request.session['profile']['first_name'], 'A.')
+        self.assertEqual(email_values(request.session['profile']),
+                         ['a@example.org', 'aaron@example.org'])
+
+        self.server.route('POST', '/api/contact_infos.json', {}, status=422)
+        request = self.make_profile_request()
+        with self.assertRaises(HTTPError):
+            self.run_until_complete(accounts.update_profile(
+                request, first_name='B.', email='b@example.org'))
+        self.assertEqual(request.session['profile']['first_name'], 'B.')
+
+    def test_send_messages(self):
+        self.route_send_message({'aaron': 1, 'babara': 2, 'caitlin': 3})
+        self.set_up_message_sender()
+        accounts = self.make_one(message_batch_size='2')
+        self.run_until_complete(accounts.request_application_token())
+        results = self.run_until_complete(accounts.send_messages(
+            ['aaron', 'babara', 'nobody', 'caitlin'], 'Hi', 'Hello'))
+        self.assertEqual(results.pop('nobody').__class__.__name__,
+                         'UserNotFoundException')
+        self.assertEqual(results, {'aaron': True, 'babara': True,
+                                   'caitlin': True})
+        paths = [path for method, path, query in self.server.requests]
+        self.assertEqual(paths, ['/oauth/token', '/api/users.json',
+                                 '/api/messages.json', '/api/messages.json'])
+
+    def test_get_profiles_by_usernames(self):
+        usernames = ['user{}'.format(i) for i in range(5)]
+        self.route_profiles(usernames)
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+        profiles = self.run_until_complete(
+            accounts.get_profiles_by_usernames(usernames + ['nobody'], 2))
+        self.assertEqual(profiles['nobody'], None)
+        self.assertEqual(profiles['user3'], {'username': 'user3'})
+        self.assertEqual(len(profiles), 6)
+
+    def test_iter_search(self):
+        users = [{'id': i, 'username': 'user{}'.format(i)}
+                 for i in range(25)]
+        self.route_search(users)
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+
+        async_gen = accounts.iter_search('%', page_size=10, prefetch=2)
+        results = []
+        while True:
+            try:
+                results.append(
+                    self.run_until_complete(async_gen.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(results, users)
+        self.assertEqual(sorted(query['page'] for method, path, query
+                                in self.server.requests[1:]),
+                         ['1', '2', '3'])
+
+    def test_iter_search_capped_page_size(self):
+        users = [{'id': i, 'username': 'user{}'.format(i)}
+                 for i in range(250)]
+        self.route_search(users, max_per_page=50)
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+
+        async_gen = accounts.iter_search('%', page_size=100, prefetch=2)
+        results = []
+        while True:
+            try:
+                results.append(
+                    self.run_until_complete(async_gen.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(results, users)
+
+    def test_timeout_and_retries(self):
+        import asyncio
+        attempts = []
+
+        def flaky(handler):
+            attempts.append(None)
+            if len(attempts) < 3:
+                time.sleep(0.2)
+            return 200, {}, {'id': 1}
+
+        self.server.route('GET', '/api/user.json', flaky)
+        accounts = self.make_one(**{'timeout.profile': '0.05',
+                                    'retry_backoff': '0.01'})
+        self.run_until_complete(accounts.request_application_token())
+        self.assertEqual(self.run_until_complete(accounts.get_profile()),
+                         {'id': 1})
+        self.assertEqual(len(attempts), 3)
+
+        del attempts[:]
+        accounts.retries = 1
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_until_complete(accounts.get_profile())
+        self.assertEqual(len(attempts), 2)
+
+    def test_conditional_get_profile(self):
+        self.server.route('GET', '/api/user.json', {'id': 1},
+                          headers={'ETag': '"v1"'})
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+        first = self.run_until_complete(accounts.get_profile())
+        first['name'] = 'x'
+        second = self.run_until_complete(accounts.get_profile())
+        self.assertEqual(second, {'id': 1})
+        self.assertEqual(self.server.statuses[-2:], [200, 304])
+
+    def test_circuit_breaker(self):
+        from .resilience import CircuitOpenError
+        self.server.route('GET', '/api/user.json', {}, status=503)
+        accounts = self.make_one(**{
+            'retries': '0',
+            'circuit_breaker.failure_threshold': '2',
+            })
+        self.run_until_complete(accounts.request_application_token())
+        for i in range(2):
+            with self.assertRaises(Exception):
+                self.run_until_complete(accounts.get_profile())
+        del self.server.requests[:]
+        with self.assertRaises(CircuitOpenError):
+            self.run_until_complete(accounts.get_profile())
+        self.assertEqual(self.server.requests, [])
+
+    def test_blocking_message_sender(self):
+        from .interfaces import IMessageSender
+        config = self.set_up_message_sender()
+        released = threading.Event()
+        waited = []
+
+        def send(msg_data):
+            # E.g. a full message queue.
+            waited.append(released.wait(1))
+
+        config.registry.registerUtility(send, IMessageSender)
+        accounts = self.make_one()
+        accounts.userid_cache.set('aaron', 1)
+
+        self.loop.call_later(0.01, released.set)
+        self.run_until_complete(
+            accounts.send_message('aaron', 'Hi', 'Hello'))
+        # The event loop was free to release the sender.
+        self.assertEqual(waited, [True])
+
+    def test_send_message_stale_userid(self):
+        self.route_send_message({'aaron': 1})
+        self.set_up_message_sender()
+        accounts = self.make_one()
+        self.run_until_complete(accounts.request_application_token())
+        accounts.userid_cache.set('aaron', 99)
+        self.run_until_complete(accounts.send_message('aaron', 'Hi', 'Hello'))
+        paths = [path for method, path, query in self.server.requests]
+        self.assertEqual(paths, ['/oauth/token', '/api/messages.json',
+                                 '/api/users.json', '/api/messages.json'])
+
+
+class StubSearchTests(unittest.TestCase):
+
+    def make_one(self):
+        from .stub import OpenstaxAccounts, get_users_from_settings
+        return OpenstaxAccounts(get_users_from_settings("""
+            aaron,password,{"first_name": "Aaron", "last_name": "Andersen"}
+            aaronson,password,{"first_name": "Zed", "last_name": "Aaronson"}
+            babara,password,{}
+            caitlin,password
+            dale,password
+            """))
+
+    def usernames(self, results):
+        return [profile['username'] for profile in results['items']]
+
+    def test_parse_query(self):
+        from .stub import parse_query
+        self.assertEqual(parse_query('username:aaron,babara  %son'), [
+            ('username', ['aaron', 'babara']),
+            (None, ['%son']),
+            ])
+        self.assertEqual(parse_query('name:"Test User" bogus:x'), [
+            ('name', ['Test User']),
+            (None, ['bogus:x']),
+            ])
+
+    def test_search(self):
+        accounts = self.make_one()
+        self.assertEqual(self.usernames(accounts.search('username:aaron')),
+                         ['aaron', 'aaronson'])
+        self.assertEqual(
+            self.usernames(accounts.search('username:aaron,dale')),
+            ['aaron', 'aaronson', 'dale'])
+        # Substrings of the query no longer match.
+        self.assertEqual(self.usernames(accounts.search('username:aaronx')),
+                         [])
+        self.assertEqual(self.usernames(accounts.search('%son')),
+                         ['aaronson'])
+        self.assertEqual(self.usernames(accounts.search('first_name:test')),
+                         ['caitlin', 'dale'])
+        self.assertEqual(
+            self.usernames(accounts.search('name:test last_name:us%r')),
+            ['caitlin', 'dale'])
+        self.assertEqual(self.usernames(accounts.search('id:3')),
+                         ['babara'])
+        results = accounts.search('%')
+        self.assertEqual(results['total_count'], 5)
+        self.assertEqual(self.usernames(results),
+                         ['aaron', 'aaronson', 'babara', 'caitlin', 'dale'])
+
+    def test_order_by(self):
+        accounts = self.make_one()
+        self.assertEqual(
+            self.usernames(accounts.search(
+                '%', order_by='first_name, username DESC')),
+            ['aaron', 'dale', 'caitlin', 'aaronson', 'babara'])
+        # Missing values come first when descending, ties by username.
+        self.assertEqual(
+            self.usernames(accounts.search('%', order_by='last_name DESC')),
+            ['babara', 'caitlin', 'dale', 'aaron', 'aaronson'])
+        results = accounts.search('%', order_by='last_name DESC',
+                                  page=2, per_page=2)
+        self.assertEqual(results['total_count'], 5)
+        self.assertEqual(self.usernames(results), ['dale', 'aaron'])
+        results = accounts.search('%', page=3, per_page=2)
+        self.assertEqual(self.usernames(results), ['dale'])
+
+    def test_iter_search(self):
+        accounts = self.make_one()
+        pages = []
+        search = accounts.search
+
+        def paged_search(query, **kwargs):
+            pages.append((kwargs['page'], kwargs['per_page']))
+            return search(query, **kwargs)
+
+        accounts.search = paged_search
+        self.assertEqual(
+            [profile['username'] for profile in accounts.iter_search(
+                '%', page_size=2, order_by='username DESC')],
+            ['dale', 'caitlin', 'babara', 'aaronson', 'aaron'])
+        self.assertEqual(pages, [(1, 2), (2, 2), (3, 2)])
+        self.assertEqual(list(accounts.iter_search('username:nobody')), [])
+
+    def test_sort_key(self):
+        index = self.make_one().users.search_index
+        for order_by in ('first_name, username DESC', 'last_name DESC',
+                         'username DESC', 'first_name DESC, last_name'):
+            # Sorting a few matches gives the order of all the users.
+            self.assertEqual(
+                sorted(index.profiles, key=index.sort_key(order_by)),
+                index.ordered(order_by))
+        self.assertEqual(
+            index.ordered('first_name DESC, last_name'),
+            ['babara', 'aaronson', 'caitlin', 'dale', 'aaron'])
+
+    def test_lookups(self):
+        accounts = self.make_one()
+        users = accounts.users
+        self.assertEqual(len(users), 5)
+        self.assertEqual(users.profile('babara')['id'], 3)
+        self.assertEqual(users.profile('nobody'), None)
+        self.assertEqual(users.profile_by_id(4)['username'], 'caitlin')
+        self.assertEqual(users.profile_by_id('4')['username'], 'caitlin')
+        self.assertEqual(users.profile_by_id(42), None)
+        self.assertEqual(users.profile_by_id('x'), None)
+        self.assertEqual(
+            dict((userid, profile and profile['username'])
+                 for userid, profile in users.profiles_by_ids([1, 9]).items()),
+            {1: 'aaron', 9: None})
+        self.assertEqual(accounts.get_profile_by_username('dale')['id'], 5)
+        profiles = accounts.get_profiles_by_usernames(['aaron', 'nobody'])
+        self.assertEqual(profiles['aaron']['first_name'], 'Aaron')
+        self.assertEqual(profiles['nobody'], None)
+
+        # New users are found by the searches that follow.
+        self.assertEqual(self.usernames(accounts.search('username:ed')), [])
+        users.add('ed', 'password', {'id': 6, 'username': 'ed'})
+        self.assertEqual(self.usernames(accounts.search('username:ed')),
+                         ['ed'])
+        self.assertEqual(users.profile_by_id(6)['username'], 'ed')
+
+    def test_send_messages(self):
+        from pyramid import testing
+        from .stub import IStubMessageWriter, MemoryWriter, OpenstaxAccounts
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        writer = MemoryWriter()
+        config.registry.registerUtility(writer, IStubMessageWriter)
+        accounts = OpenstaxAccounts(self.make_one().users,
+                                    message_batch_size=2)
+        results = accounts.send_messages(
+            ['aaron', 'babara', 'nobody', 'caitlin'], 'Hi', 'Hello')
+        self.assertEqual(results.pop('nobody').__class__.__name__,
+                         'UserNotFoundException')
+        self.assertEqual(results, {'aaron': True, 'babara': True,
+                                   'caitlin': True})
+        # Batched like the accounts client.
+        self.assertEqual([json.loads(message)['to[user_ids][]']
+                          for message in writer.messages],
+                         [[1, 3], [4]])
+
+    def test_users_from_mapping(self):
+        from .stub import OpenstaxAccounts
+        accounts = OpenstaxAccounts({
+            'aaron': {'password': 'password',
+                      'profile': {'id': 1, 'username': 'aaron'}},
+            })
+        self.assertEqual(accounts.users.profile_by_id(1)['username'], 'aaron')
+        self.assertEqual(accounts.users['aaron']['password'], 'password')
+
+    def test_load_users(self):
+        import io
+        import shutil
+        import tempfile
+        from .stub import load_users
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        csv_path = os.path.join(directory, 'users.csv')
+        with io.open(csv_path, 'w', encoding='utf-8') as f:
+            f.write(u'username,password,first_name,last_name\n'
+                    u'babara,secret,Babara,\n'
+                    u'caitlin,password,Zo\xeb,\n')
+        json_path = os.path.join(directory, 'users.jsonl')
+        with open(json_path, 'w') as f:
+            f.write('{"username": "dale", "password": "password", '
+                    '"profile": {"id": 40, "first_name": "Dale"}}\n\n'
+                    '{"username": "earl", "password": "password"}\n')
+
+        users = load_users({
+            'stub.users': 'aaron,password',
+            'stub.users_file': csv_path,
+            'stub.synthetic_users': '3',
+            })
+        self.assertEqual(sorted(users), [
+            'aaron', 'babara', 'caitlin', 'user4', 'user5', 'user6'])
+        self.assertEqual(users['babara']['password'], 'secret')
+        babara = users.profile('babara')
+        self.assertEqual((babara['id'], babara['first_name'],
+                          babara['last_name']), (2, 'Babara', 'User'))
+        self.assertEqual(users.profile('caitlin')['first_name'], u'Zo\xeb')
+        self.assertEqual(users.profile('caitlin')['last_name'], 'User')
+        self.assertEqual(users.profile_by_id(6)['username'], 'user6')
+        # The default fields are shared, not copied.
+        self.assertTrue(users.profile('user4')['full_name'] is
+                        users.profile('user5')['full_name'])
+
+        users = load_users({'stub.users_file': json_path,
+                            'stub.synthetic_users': '2'})
+        self.assertEqual(users.profile_by_id(40)['first_name'], 'Dale')
+        earl = users.profile('earl')
+        # Numbered after the greatest id.
+        self.assertEqual((earl['id'], earl['first_name']), (41, 'Test'))
+        self.assertEqual(users.profile_by_id(42)['username'], 'user42')
+        self.assertEqual(users.profile_by_id(43)['username'], 'user43')
+
+        with open(json_path, 'a') as f:
+            f.write('{"username": "fabian", "password": "password", '
+                    '"profile": {"id": 40}}\n')
+        with self.assertRaises(ValueError):
+            load_users({'stub.users_file': json_path})
+
+
+class StubMessageWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'messages.txt')
+
+    def make_file_writer(self, **kwargs):
+        from .stub import FileWriter
+        writer = FileWriter(path=self.path, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def read(self, path=None):
+        if not os.path.exists(path or self.path):
+            return []
+        with open(path or self.path) as f:
+            return [x for x in f.read().split('\n\n\n') if x]
+
+    def test_file_writer_buffers(self):
+        writer = self.make_file_writer(buffer_size=30, flush_interval=60)
+        writer.write('{"subject": "1"}')
+        self.assertEqual(self.read(), [])
+        # Written once the buffer is full.
+        writer.write('{"subject": "2"}')
+        self.assertEqual(self.read(),
+                         ['{"subject": "1"}', '{"subject": "2"}'])
+        writer.write('{"subject": "3"}')
+        writer.close()
+        self.assertEqual(len(self.read()), 3)
+        # Still usable after being closed.
+        writer.write('{"subject": "4"}')
+        writer.flush()
+        self.assertEqual(len(self.read()), 4)
+
+    def test_file_writer_flush_interval(self):
+        writer = self.make_file_writer(flush_interval=0.05)
+        writer.write('message')
+        for i in range(100):
+            if self.read():
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.read(), ['message'])
+
+    def test_file_writer_threads(self):
+        writer = self.make_file_writer(buffer_size=100, flush_interval=0.01)
+
+        def write(i):
+            for j in range(200):
+                writer.write('{}-{}'.format(i, j))
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        messages = self.read()
+        self.assertEqual(len(messages), 800)
+        self.assertEqual(len(set(messages)), 800)
+
+    def test_file_writer_rotation(self):
+        writer = self.make_file_writer(buffer_size=0, max_bytes=25,
+                                       backup_count=2)
+        for i in range(5):
+            # 13 bytes with the delimiter, two messages per file.
+            writer.write('message {}'.format(i))
+        self.assertEqual(self.read(), ['message 4'])
+        self.assertEqual(self.read(self.path + '.1'),
+                         ['message 2', 'message 3'])
+        self.assertEqual(self.read(self.path + '.2'),
+                         ['message 0', 'message 1'])
+        writer.write('message 5')
+        writer.write('message 6')
+        self.assertEqual(self.read(), ['message 6'])
+        self.assertEqual(self.read(self.path + '.2'),
+                         ['message 2', 'message 3'])
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_memory_writer(self):
+        from .openstax_accounts import build_message_data
+        from .stub import MemoryWriter
+        writer = MemoryWriter(capacity=3)
+
+        def send(userids, subject):
+            writer.write(json.dumps(
+                build_message_data(userids, subject, 'Hi')))
+
+        send(1, 'a')
+        send([1, 2, 1], 'b')
+        send(3, 'a')
+        self.assertEqual([m.subject for m in writer.by_recipient(1)],
+                         ['a', 'b'])
+        self.assertEqual([m.user_ids for m in writer.by_subject('a')],
+                         [(1,), (3,)])
+        message = writer.by_recipient('2')[0]
+        self.assertEqual(message.data,
+                         build_message_data([1, 2, 1], 'b', 'Hi'))
+        self.assertEqual(json.loads(writer.messages[0]),
+                         build_message_data(1, 'a', 'Hi'))
+
+        # The oldest messages make room for the new ones.
+        send(2, 'c')
+        send(3, 'c')
+        self.assertEqual((len(writer), writer.written, writer.dropped),
+                         (3, 5, 2))
+        self.assertEqual(writer.by_recipient(1), [])
+        self.assertEqual([m.subject for m in writer.by_recipient(3)],
+                         ['a', 'c'])
+        self.assertEqual(writer.by_subject('b'), [])
+        self.assertEqual(len(writer.by_subject('c')), 2)
+
+        writer.clear()
+        self.assertEqual((len(writer), writer.dropped), (0, 2))
+        self.assertEqual(writer.by_subject('c'), [])
+
+        # BBB Resetting the messages.
+        send(1, 'd')
+        writer.messages = []
+        self.assertEqual((len(writer), writer.by_recipient(1)), (0, []))
+
+        writer = MemoryWriter(capacity=0)
+        for i in range(5):
+            send(1, 'a')
+        self.assertEqual((len(writer), writer.dropped), (5, 0))
+        with self.assertRaises(ValueError):
+            MemoryWriter(capacity=-1)
+
 
 class InterfaceTests(unittest.TestCase):
     """Verify the classes implement the interfaces."""
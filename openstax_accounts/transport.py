@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2015, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Pooled keep-alive HTTP transport used to talk to the accounts server."""
+import io
+import select
+import socket
+import ssl
+import threading
+try:
+    import httplib  # python2
+except ImportError:
+    import http.client as httplib  # renamed in python3
+try:
+    import Queue as queue  # python2
+except ImportError:
+    import queue  # renamed in python3
+try:
+    import urlparse  # python2
+except ImportError:
+    import urllib.parse as urlparse  # renamed in python3
+try:
+    from urllib2 import HTTPError  # python2
+except ImportError:
+    from urllib.error import HTTPError  # moved in python3
+
+
+__all__ = ('Response', 'Transport', 'HTTPError')
+
+
+DEFAULT_POOL_SIZE = 10
+
+# Errors that indicate a kept-alive connection was closed by the server
+# while it sat in the pool. The request is retried on a fresh connection
+# if it is idempotent, or if it had not been sent yet.
+_STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, socket.error)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+def _is_dropped(conn):
+    """Whether the server has closed the idle connection ``conn``, which
+    then reads as ready (end of file).
+    """
+    if conn.sock is None:
+        # Connects again when used.
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (ValueError, select.error, socket.error):
+        return True
+
+
+def make_ssl_context(verify=True):
+    """Creates the TLS context shared by every pooled https connection."""
+    if verify:
+        return ssl.create_default_context()
+    if hasattr(ssl, '_create_unverified_context'):
+        return ssl._create_unverified_context()
+    return None
+
+
+def _content_charset(headers):
+    content_type = headers.get('content-type') or ''
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return value.strip('"\'').lower()
+    return None
+
+
+class Response(object):
+    """A fully read response from the accounts server."""
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    @property
+    def text(self):
+        return self.data.decode(_content_charset(self.headers) or 'utf-8')
+
+
+class Transport(object):
+    """Thread-safe pool of persistent HTTP(S) connections.
+
+    Connections are kept per ``(scheme, host, port)`` and handed out in
+    LIFO order so that the most recently used (and most likely still open)
+    connection is reused first. At most ``pool_size`` idle connections are
+    kept per host; more may be opened under load, but the extras are
+    closed rather than returned to the pool.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None,
+                 verify_ssl=True, ssl_context=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        if ssl_context is None:
+            ssl_context = make_ssl_context(verify_ssl)
+        self.ssl_context = ssl_context
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = queue.LifoQueue(self.pool_size)
+            return pool
+
+    def _new_connection(self, scheme, host, port):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port,
+                                           context=self.ssl_context, **kwargs)
+        return httplib.HTTPConnection(host, port, **kwargs)
+
+    def _get_connection(self, key):
+        pool = self._pool(key)
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                return self._new_connection(*key), False
+            if not _is_dropped(conn):
+                return conn, True
+            conn.close()
+
+    def _put_connection(self, key, conn):
+        try:
+            self._pool(key).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Sends the request and returns a :class:`Response`.
+        Raises ``HTTPError`` for 4xx and 5xx responses,
+        the same way ``urlopen`` does. ``timeout`` overrides the
+        transport's socket timeout for this request.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname,
+               parts.port or (443 if scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+
+        while True:
+            conn, reused = self._get_connection(key)
+            conn.timeout = timeout
+            sent = False
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                data = resp.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and (not sent or method in IDEMPOTENT_METHODS):
+                    # The pooled connection went away, try a new one. A
+                    # request with side effects is not sent twice, the
+                    # server may have received it.
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_connection(key, conn)
+
+        response = Response(resp.status, resp.reason, resp.msg, data)
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.msg,
+                            io.BytesIO(data))
+        return response
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
@@ -5,9 +5,55 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import functools
+import sys
+import threading
+try:
+    import Queue as queue  # python2
+except ImportError:
+    import queue  # renamed in python3
 
 
-__all__ = ('local_settings')
+__all__ = (
+    'chunked', 'clear_request_memo', 'local_settings', 'memoized_on_request',
+    'prefetched',
+    )
+
+
+def chunked(items, size):
+    """Splits the ``items`` sequence into lists of at most ``size`` items."""
+    return [list(items[i:i + size]) for i in range(0, len(items), size)]
+
+
+# Name of the request attribute ``memoized_on_request`` results are kept in.
+_REQUEST_MEMO = '_openstax_accounts_memo'
+
+
+def memoized_on_request(method):
+    """Decorates a ``method(self, request)`` (e.g. of an authentication
+    policy) so that it runs once per request, its result is kept on the
+    request until ``clear_request_memo`` is called.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, request):
+        memo = request.__dict__.get(_REQUEST_MEMO)
+        if memo is None:
+            memo = request.__dict__[_REQUEST_MEMO] = {}
+        key = (id(self), name)
+        if key not in memo:
+            result = method(self, request)
+            # ``method`` may have cleared the memo, e.g. by remembering.
+            request.__dict__.setdefault(_REQUEST_MEMO, {})[key] = result
+            return result
+        return memo[key]
+    return wrapper
+
+
+def clear_request_memo(request):
+    """Forgets the ``memoized_on_request`` results kept on ``request``."""
+    request.__dict__.pop(_REQUEST_MEMO, None)
 
 
 def local_settings(settings, prefix='openstax_accounts'):
@@ -26,3 +72,53 @@ def local_settings(settings, prefix='openstax_accounts'):
     new_settings = {k[len(prefix):]:v for k, v in settings.items()
                     if k.startswith(prefix)}
     return new_settings
+
+
+def prefetched(iterable, size=1):
+    """Iterates over ``iterable`` in a background thread, keeping at most
+    ``size`` items ready ahead of the consumer. Exceptions raised by the
+    iterable are raised to the consumer. With a ``size`` of zero the
+    iterable is consumed directly.
+    """
+    if size <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    items = queue.Queue(size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Waits for room, but gives up once the consumer has stopped.
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, exc_info = items.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[1]
+                return
+            yield item
+    finally:
+        # Also stops the producer when the consumer stops early.
+        stopped.set()